@@ -0,0 +1,803 @@
+#!/usr/bin/env python3
+"""
+Benchmark the ETL transform hot paths against synthetic records
+example usage: "python benchmark.py remove_dupe_rows --rows 10000 100000 1000000"
+
+The `suite` benchmark times every transform, and records its peak memory, at 1k, 10k,
+100k and 1M rows. Save the results with --output and check a later run against them
+with --baseline:
+
+    python benchmark.py suite --output baseline.json
+    python benchmark.py suite --baseline baseline.json
+"""
+import argparse
+import gc
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import resource
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import arrow
+
+from config import FIELD_MAPS, SOCRATA_DATASETS, string_list_order
+import s3_cache
+import s3_to_knack
+import s3_to_socrata
+import upload_to_s3
+
+
+def random_text(rand, length=12):
+    return "".join(rand.choices(string.ascii_uppercase + string.digits, k=length))
+
+
+def make_task_orders(rows, seed=0):
+    """ return a list of synthetic task order records, shaped like the task_orders query """
+    rand = random.Random(seed)
+    records = []
+    for i in range(rows):
+        records.append(
+            {
+                "TASK_ORDER_DEPT": "2400",
+                "TASK_ORDER_ID": f"TK{i:08d}",
+                "TASK_ORDER_DESC": random_text(rand, 40),
+                "TASK_ORDER_STATUS": rand.choice(["ACTIVE", "INACTIVE"]),
+                "TASK_ORDER_TYPE": rand.choice(["INTERNAL", "EXTERNAL"]),
+                "TK_CURR_AMOUNT": rand.random() * 100000,
+                "CHARGED_AMOUNT": rand.random() * 100000,
+                "TASK_ORDER_BAL": rand.random() * 100000,
+                "TASK_ORDER_ESTIMATOR": random_text(rand, 8),
+                "BYR_FDU": f"{rand.randint(1000, 9999)} 2400 {rand.randint(1000, 9999)}",
+            }
+        )
+    return records
+
+
+def make_task_order_rows(rows, seed=0):
+    """Return synthetic task order rows where each task order has 1-4 rows, one for
+    each of its buyer FDUs, some of which are null or repeated"""
+    rand = random.Random(seed)
+    records = []
+    for rec in make_task_orders(rows // 2, seed):
+        for _ in range(rand.randint(1, 4)):
+            row = dict(rec)
+            row["BYR_FDU"] = rand.choice(
+                [None, rec["BYR_FDU"], f"{rand.randint(1000, 9999)} 2400 {rand.randint(1000, 9999)}"]
+            )
+            records.append(row)
+    rand.shuffle(records)
+    return records[:rows]
+
+
+def make_subprojects(rows, seed=0):
+    """Return a list of synthetic subproject records, shaped like the subprojects
+    query, where ~2% of the rows repeat an earlier subproject"""
+    rand = random.Random(seed)
+    records = []
+    for i in range(rows):
+        if records and rand.random() < 0.02:
+            records.append(dict(rand.choice(records)))
+            continue
+        records.append(
+            {
+                "PROJECT_NUMBER": rand.randint(1000, 9999),
+                "SP_NUMBER_TXT": f"{rand.randint(1000, 9999)}.{i:07d}",
+                "SP_NAME": random_text(rand, 30),
+                "SP_DESCRIPTION": random_text(rand, 60),
+                "SP_DETAILED_SCOPE": random_text(rand, 60),
+                "SUB_PROJECT_MANAGER": random_text(rand, 12),
+                "SUB_PROJECT_MANAGING_DEPT": "2400",
+                "SP_STATUS": rand.choice(["Active", "Inactive"]),
+            }
+        )
+    return records
+
+
+def make_units(rows, seed=0):
+    """ return a list of synthetic unit records, shaped like the units query """
+    rand = random.Random(seed)
+    return [
+        {
+            "DEPT_UNIT_ID": i,
+            "DEPT_ID": rand.randint(1, 100),
+            "DEPT": rand.choice(["2400", "2507", "6200", "6207"]),
+            "UNIT": f"{rand.randint(0, 9999):04d}",
+            "UNIT_LONG_NAME": random_text(rand, 40),
+            "UNIT_SHORT_NAME": random_text(rand, 12),
+            "DEPT_UNIT_STATUS": rand.choice(["A", "I"]),
+        }
+        for i in range(rows)
+    ]
+
+
+def make_objects(rows, seed=0):
+    """ return a list of synthetic object code records, shaped like the objects query """
+    rand = random.Random(seed)
+    return [
+        {
+            "OBJ_ID": i,
+            "OBJ_CLASS_ID": rand.randint(1, 20),
+            "OBJ_CATEGORY_ID": rand.randint(1, 50),
+            "OBJ_TYPE_ID": rand.randint(1, 100),
+            "OBJ_GROUP_ID": rand.randint(1, 200),
+            "OBJ_CODE": f"{i:07d}",
+            "OBJ_LONG_NAME": random_text(rand, 40),
+            "OBJ_SHORT_NAME": random_text(rand, 12),
+            "OBJ_DESC": random_text(rand, 60),
+            "OBJ_REIMB_ELIG_STATUS": rand.choice(["Y", "N"]),
+            "OBJ_STATUS": rand.choice(["A", "I"]),
+            "ACT_FL": rand.choice([True, False]),
+        }
+        for i in range(rows)
+    ]
+
+
+def make_master_agreements(rows, seed=0):
+    """Return a list of synthetic master agreement records, shaped like the
+    master_agreements query"""
+    rand = random.Random(seed)
+    return [
+        {
+            "DOC_CD": rand.choice(["MA", "MAC", "DO"]),
+            "DOC_DEPT_CD": "2400",
+            "DOC_ID": f"MA{i:08d}",
+            "DOC_DSCR": random_text(rand, 60),
+            "DOC_PHASE_CD": rand.choice(["3", "4"]),
+            "VEND_CUST_CD": random_text(rand, 10),
+            "LGL_NM": random_text(rand, 30),
+        }
+        for i in range(rows)
+    ]
+
+
+def make_fdus(rows, seed=0):
+    """ return a list of synthetic FDU records, shaped like the fdus query """
+    rand = random.Random(seed)
+    return [
+        {
+            "DEPT_CODE_NAME": random_text(rand, 20),
+            "SUB_PROJECT_ID": rand.randint(1, 100000),
+            "SUBPROJECT_ID_UK": i,
+            "SP_NUMBER_TXT": f"{rand.randint(1000, 9999)}.{i:07d}",
+            "FDU_ID": i,
+            "FDU": f"{rand.randint(1000, 9999)} 2400 {rand.randint(1000, 9999)}",
+            "FUND": f"{rand.randint(1000, 9999)}",
+            "FUNDNAME": random_text(rand, 30),
+            "DEPT": "2400",
+            "DEPT_ID": rand.randint(1, 100),
+            "DEPT_UNIT_ID": rand.randint(1, 10000),
+            "DEPT_UNIT_STATUS": rand.choice(["A", "I"]),
+            "UNIT": f"{rand.randint(0, 9999):04d}",
+            "UNIT_LONG_NAME": random_text(rand, 40),
+            "UNIT_SHORT_NAME": random_text(rand, 12),
+        }
+        for i in range(rows)
+    ]
+
+
+# synthetic data generators for each record type in queries.QUERIES
+GENERATORS = {
+    "task_orders": make_task_orders,
+    "units": make_units,
+    "objects": make_objects,
+    "master_agreements": make_master_agreements,
+    "fdus": make_fdus,
+    "subprojects": make_subprojects,
+}
+
+
+def make_knack_records(records_current, field_map, app_name, seed=0):
+    """Return synthetic knack records for the given current records: ~80% unchanged,
+    ~10% changed, ~10% missing, plus ~5% orphans"""
+    rand = random.Random(seed)
+    records_knack = []
+    for i, rec in enumerate(records_current):
+        roll = rand.random()
+        if roll < 0.1:
+            continue
+        rec_knack = s3_to_knack.create_mapped_record(rec, field_map, app_name)
+        rec_knack["id"] = f"knack{i:08d}"
+        if roll < 0.2:
+            desc_key = field_map[2][app_name]
+            rec_knack[desc_key] = random_text(rand, 40)
+        records_knack.append(rec_knack)
+    for i in range(len(records_current) // 20):
+        rec_knack = dict(records_knack[i])
+        rec_knack[s3_to_knack.get_pks(field_map, app_name)[1]] = f"ORPHAN{i:08d}"
+        rec_knack["id"] = f"orphan{i:08d}"
+        records_knack.append(rec_knack)
+    rand.shuffle(records_knack)
+    return records_knack
+
+
+def legacy_create_mapped_record(rec_current, field_map, app_name):
+    """ The original implementation of s3_to_knack.create_mapped_record """
+    mapped_record = {}
+    for field in field_map:
+        val = rec_current.get(field["src"])
+        handler_func = field.get("handler")
+        mapped_record[field[app_name]] = val if not handler_func else handler_func(val)
+    return mapped_record
+
+
+def legacy_handle_records(records_current, records_knack, knack_pk, field_map, app_name):
+    """ The original nested-loop implementation of s3_to_knack.handle_records """
+    todos = []
+    mapped_records = [
+        legacy_create_mapped_record(rec_current, field_map, app_name)
+        for rec_current in records_current
+    ]
+    compare_keys = [field[app_name] for field in field_map if not field.get("ignore_diff")]
+    for rec_current in mapped_records:
+        matched = False
+        id_ = rec_current[knack_pk]
+        for rec_knack in records_knack:
+            if rec_knack[knack_pk] == id_:
+                matched = True
+                if not s3_to_knack.is_equal(rec_current, rec_knack, compare_keys):
+                    rec_current["id"] = rec_knack["id"]
+                    todos.append(rec_current)
+                break
+        if not matched:
+            todos.append(rec_current)
+    return todos
+
+
+def legacy_coalesce_records(records_current, coalesce_fields, current_pk, separator=",\n"):
+    """ The original implementation of s3_to_knack.coalesce_records """
+    index = {}
+    for rec in records_current:
+        _id = rec[current_pk]
+        if _id not in index.keys():
+            index[_id] = rec
+            continue
+        coal_record = index[_id]
+        for field in coalesce_fields:
+            coal_val = coal_record[field]
+            current_val = rec[field]
+            if coal_val and current_val:
+                coal_record[field] = separator.join([coal_val, current_val])
+            elif current_val:
+                coal_record[field] = current_val
+    return list(index.values())
+
+
+def legacy_remove_dupe_rows(data, primary_key):
+    """ The original list-membership implementation of s3_to_socrata.remove_dupe_rows """
+    ids = []
+    new_data = []
+    for row in data:
+        if row[primary_key] not in ids:
+            ids.append(row[primary_key])
+            new_data.append(row)
+    return new_data
+
+
+def legacy_socrata_transform(data, dataset_config):
+    """The original s3_to_socrata transforms, applied one after another, each of
+    which copies every row"""
+    if dataset_config.get("columns"):
+        data = s3_to_socrata.select_columns(
+            data, dataset_config["columns"], dataset_config.get("derived")
+        )
+    if dataset_config.get("forbidden_keys"):
+        data = s3_to_socrata.remove_forbidden_keys(data, dataset_config["forbidden_keys"])
+    dupe_counts = {}
+    if dataset_config.get("dedupe_key"):
+        data, dupe_counts = s3_to_socrata.dedupe_rows(
+            data,
+            dataset_config["dedupe_key"],
+            policy=dataset_config.get("dedupe_policy", "keep-first"),
+        )
+    return data, dupe_counts
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_handle_records(args):
+    app_name = "data-tracker"
+    field_map = FIELD_MAPS["task_orders"]["field_map"]
+    _, knack_pk = s3_to_knack.get_pks(field_map, app_name)
+
+    for rows in args.rows or [100000]:
+        records_current = make_task_orders(rows)
+        records_knack = make_knack_records(records_current, field_map, app_name)
+
+        todos, elapsed = timed(
+            s3_to_knack.handle_records,
+            records_current,
+            records_knack,
+            knack_pk,
+            field_map,
+            app_name,
+        )
+        logging.info(f"handle_records: {rows} records, {len(todos)} todos, {elapsed:.2f}s")
+
+        # the legacy implementation scans every knack record for each current record,
+        # so its cost is linear in the number of current records for a fixed knack
+        # object. we time a sample and scale it up rather than wait hours.
+        sample = records_current[: min(args.legacy_rows or 1000, rows)]
+        _, legacy_elapsed = timed(
+            legacy_handle_records, sample, records_knack, knack_pk, field_map, app_name
+        )
+        legacy_estimate = legacy_elapsed * rows / len(sample)
+        logging.info(
+            f"legacy handle_records: {legacy_estimate:.2f}s (extrapolated from {len(sample)} records)"
+        )
+        logging.info(f"speedup: {legacy_estimate / elapsed:.1f}x")
+
+
+def bench_remove_dupe_rows(args):
+    primary_key = "SP_NUMBER_TXT"
+
+    for rows in args.rows or [10000, 100000, 1000000]:
+        data = make_subprojects(rows)
+
+        (new_data, dupe_counts), elapsed = timed(
+            s3_to_socrata.dedupe_rows, data, primary_key
+        )
+        logging.info(
+            f"remove_dupe_rows: {rows} rows, {len(new_data)} unique, {sum(dupe_counts.values())} dupes, {elapsed:.3f}s"
+        )
+
+        # the legacy implementation is quadratic, so past --legacy-rows we time a
+        # prefix of the rows and scale it up by the square of the ratio
+        sample = data[: min(args.legacy_rows or 10000, rows)]
+        legacy_data, legacy_elapsed = timed(legacy_remove_dupe_rows, sample, primary_key)
+        assert legacy_data == new_data[: len(legacy_data)]
+        legacy_estimate = legacy_elapsed * (rows / len(sample)) ** 2
+        note = "" if len(sample) == rows else f" (extrapolated from {len(sample)} rows)"
+        logging.info(f"legacy remove_dupe_rows: {legacy_estimate:.3f}s{note}")
+        logging.info(f"speedup: {legacy_estimate / elapsed:.1f}x")
+
+
+def bench_create_mapped_record(args):
+    app_name = "data-tracker"
+    field_map = FIELD_MAPS["task_orders"]["field_map"]
+    # run-constant fields (the modified timestamp) may differ between the two runs
+    constant_keys = [field[app_name] for field in field_map if field.get("run_constant")]
+
+    for rows in args.rows or [100000]:
+        records_current = make_task_orders(rows)
+
+        legacy_mapped, legacy_elapsed = timed(
+            lambda: [
+                legacy_create_mapped_record(rec, field_map, app_name)
+                for rec in records_current
+            ]
+        )
+
+        def map_compiled():
+            transformer = s3_to_knack.compile_field_map(field_map, app_name)
+            return [s3_to_knack.map_record(rec, transformer) for rec in records_current]
+
+        mapped, elapsed = timed(map_compiled)
+
+        for rec in legacy_mapped + mapped:
+            for key in constant_keys:
+                rec[key] = None
+        assert json.dumps(legacy_mapped) == json.dumps(mapped)
+
+        logging.info(
+            f"create_mapped_record: {rows} records, {legacy_elapsed / rows * 1e6:.2f}us per record"
+        )
+        logging.info(
+            f"compiled map_record: {rows} records, {elapsed / rows * 1e6:.2f}us per record"
+        )
+        logging.info(f"speedup: {legacy_elapsed / elapsed:.1f}x")
+
+
+def bench_coalesce_records(args):
+    coalesce_fields = ["BYR_FDU"]
+
+    for rows in args.rows or [10000, 100000, 1000000]:
+        data = make_task_order_rows(rows)
+        # both implementations modify the records in place
+        legacy_data = [dict(row) for row in data]
+
+        def legacy_coalesce_and_normalize():
+            # coalesce, then sort each value with the string_list_order field handler
+            records = legacy_coalesce_records(legacy_data, coalesce_fields, "TASK_ORDER_ID")
+            for rec in records:
+                for field in coalesce_fields:
+                    rec[field] = string_list_order(rec[field])
+            return records
+
+        legacy_records, legacy_elapsed = timed(legacy_coalesce_and_normalize)
+        records, elapsed = timed(
+            s3_to_knack.coalesce_records,
+            data,
+            coalesce_fields,
+            "TASK_ORDER_ID",
+            sort=True,
+        )
+        assert records == legacy_records
+
+        logging.info(
+            f"legacy coalesce_records + string_list_order: {rows} rows, {len(records)} records, {legacy_elapsed:.3f}s"
+        )
+        logging.info(f"coalesce_records: {rows} rows, {elapsed:.3f}s")
+        logging.info(f"speedup: {legacy_elapsed / elapsed:.1f}x")
+
+
+def bench_socrata_transform(args):
+    # every combination of transforms, as well as the registered datasets
+    cases = {
+        **SOCRATA_DATASETS,
+        "all_transforms": {
+            **SOCRATA_DATASETS["task_orders"],
+            "forbidden_keys": ["TK_TYPE", "DISPLAY_NAME"],
+            "dedupe_key": ["DEPT", "BUYER_FDUS"],
+        },
+    }
+    for rows in args.rows or [10000, 100000, 1000000]:
+        for name, dataset_config in cases.items():
+            data = GENERATORS[dataset_config["record_type"]](rows)
+            # neither implementation modifies its input, so it can be reused
+            setup = lambda rows: (data, dataset_config)
+            legacy_elapsed, legacy_peak = measure(setup, legacy_socrata_transform, rows)
+            elapsed, peak = measure(setup, s3_to_socrata.transform, rows)
+            logging.info(
+                f"{name}: {rows} rows, legacy {legacy_elapsed:.3f}s peak {legacy_peak / 1024 ** 2:.1f}MB, fused {elapsed:.3f}s peak {peak / 1024 ** 2:.1f}MB, speedup {legacy_elapsed / elapsed:.1f}x"
+            )
+
+
+def legacy_pipeline(tmp_dir, records_knack, knack_pk, field_map, app_name):
+    """The original s3_to_knack pipeline: decode the whole JSON file, then filter,
+    coalesce and diff full lists"""
+    with open(os.path.join(tmp_dir, "task_orders.json"), "rb") as fin:
+        records = json.loads(fin.read().decode())
+    records = list(filter(lambda rec: True, records))
+    records = s3_to_knack.coalesce_records(records, ["BYR_FDU"], "TASK_ORDER_ID")
+    return legacy_handle_records_indexed(
+        records, records_knack, knack_pk, field_map, app_name
+    )
+
+
+def legacy_handle_records_indexed(records_current, records_knack, knack_pk, field_map, app_name):
+    """The original handle_records memory profile (all records mapped into a list up
+    front) with an indexed lookup, so that the benchmark finishes"""
+    todos = []
+    mapped_records = [
+        legacy_create_mapped_record(rec, field_map, app_name) for rec in records_current
+    ]
+    knack_index = {rec_knack[knack_pk]: rec_knack for rec_knack in records_knack}
+    compare_keys = [field[app_name] for field in field_map if not field.get("ignore_diff")]
+    for rec_current in mapped_records:
+        rec_knack = knack_index.get(rec_current[knack_pk])
+        if rec_knack is None:
+            todos.append(rec_current)
+        elif not s3_to_knack.is_equal(rec_current, rec_knack, compare_keys):
+            rec_current["id"] = rec_knack["id"]
+            todos.append(rec_current)
+    return todos
+
+
+def streaming_pipeline(tmp_dir, records_knack, knack_pk, field_map, app_name):
+    """The streaming s3_to_knack pipeline: decode, filter, coalesce, map and diff
+    the records as they are read"""
+    with open(os.path.join(tmp_dir, "task_orders.manifest.json")) as fin:
+        manifest = json.load(fin)
+    with open(os.path.join(tmp_dir, "task_orders.ndjson.gz"), "rb") as body:
+        records = s3_cache.iter_ndjson(body, manifest)
+        records = s3_to_knack.apply_src_data_filter(records, lambda rec: True)
+        records = s3_to_knack.coalesce_records(records, ["BYR_FDU"], "TASK_ORDER_ID")
+        diff = s3_to_knack.diff_records(
+            records, records_knack, knack_pk, field_map, app_name, keep_unchanged=False
+        )
+    return diff["todos"]
+
+
+def peak_rss():
+    """Return the peak RSS of this process in kilobytes. On linux this is read from
+    /proc, because ru_maxrss carries over the parent's peak into a spawned process"""
+    try:
+        with open("/proc/self/status") as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure_peak_rss(pipeline, queue, tmp_dir, *args):
+    """Run a pipeline and report its peak RSS, and the peak RSS before it started,
+    once the knack records are loaded"""
+    with open(os.path.join(tmp_dir, "knack.pickle"), "rb") as fin:
+        records_knack = pickle.load(fin)
+    rss_start = peak_rss()
+    todos = pipeline(tmp_dir, records_knack, *args)
+    queue.put((rss_start, peak_rss(), len(todos)))
+
+
+def bench_pipeline_memory(args):
+    app_name = "data-tracker"
+    field_map = FIELD_MAPS["task_orders"]["field_map"]
+    _, knack_pk = s3_to_knack.get_pks(field_map, app_name)
+    # each pipeline runs in a fresh process so that we can read its peak RSS
+    context = multiprocessing.get_context("spawn")
+
+    for rows in args.rows or [500000]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            records = make_task_orders(rows)
+            with open(os.path.join(tmp_dir, "knack.pickle"), "wb") as fout:
+                pickle.dump(make_knack_records(records, field_map, app_name), fout)
+            with open(os.path.join(tmp_dir, "task_orders.json"), "w") as fout:
+                json.dump(records, fout)
+            lines = "".join(json.dumps(rec) + "\n" for rec in records).encode()
+            with gzip.open(os.path.join(tmp_dir, "task_orders.ndjson.gz"), "wb") as fout:
+                fout.write(lines)
+            with open(os.path.join(tmp_dir, "task_orders.manifest.json"), "w") as fout:
+                json.dump(
+                    {
+                        "format": "ndjson.gz",
+                        "file": "task_orders.ndjson.gz",
+                        "rows": rows,
+                        "sha256": hashlib.sha256(lines).hexdigest(),
+                    },
+                    fout,
+                )
+            del records, lines
+
+            for pipeline in (legacy_pipeline, streaming_pipeline):
+                queue = context.Queue()
+                process = context.Process(
+                    target=measure_peak_rss,
+                    args=(pipeline, queue, tmp_dir, knack_pk, field_map, app_name),
+                )
+                process.start()
+                rss_start, rss_peak, count = queue.get()
+                process.join()
+                logging.info(
+                    f"{pipeline.__name__}: {rows} records, {count} todos, peak RSS {rss_peak / 1024:.0f}MB ({(rss_peak - rss_start) / 1024:.0f}MB above baseline)"
+                )
+
+
+def setup_handle_records(rows):
+    app_name = "data-tracker"
+    field_map = FIELD_MAPS["task_orders"]["field_map"]
+    _, knack_pk = s3_to_knack.get_pks(field_map, app_name)
+    records_current = make_task_orders(rows)
+    records_knack = make_knack_records(records_current, field_map, app_name)
+    return records_current, records_knack, knack_pk, field_map, app_name
+
+
+def setup_create_mapped_record(record_type):
+    def setup(rows):
+        return GENERATORS[record_type](rows), FIELD_MAPS[record_type]["field_map"]
+
+    return setup
+
+
+def run_create_mapped_record(records, field_map):
+    return [
+        s3_to_knack.create_mapped_record(rec, field_map, "finance-purchasing")
+        for rec in records
+    ]
+
+
+def setup_fileobj(record_type):
+    def setup(rows):
+        return upload_to_s3.fileobj, GENERATORS[record_type](rows)
+
+    return setup
+
+
+# the cases of the benchmark suite. each is (setup, run), where setup(rows) returns
+# the arguments of run, and only run is measured
+SUITE = {
+    "handle_records": (setup_handle_records, s3_to_knack.handle_records),
+    **{
+        f"create_mapped_record[{record_type}]": (
+            setup_create_mapped_record(record_type),
+            run_create_mapped_record,
+        )
+        for record_type in FIELD_MAPS
+    },
+    "coalesce_records": (
+        lambda rows: (make_task_order_rows(rows), ["BYR_FDU"], "TASK_ORDER_ID"),
+        lambda *args: s3_to_knack.coalesce_records(*args, sort=True),
+    ),
+    "apply_src_data_filter": (
+        lambda rows: (make_units(rows), lambda rec: rec["DEPT"] == "2400"),
+        lambda *args: list(s3_to_knack.apply_src_data_filter(*args)),
+    ),
+    "transform_tks": (lambda rows: (make_task_orders(rows),), s3_to_socrata.transform_tks),
+    "remove_forbidden_keys": (
+        lambda rows: (
+            make_subprojects(rows),
+            ["SUB_PROJECT_LAST_UPDATE_BY", "SUB_PROJECT_MANAGER"],
+        ),
+        s3_to_socrata.remove_forbidden_keys,
+    ),
+    "remove_dupe_rows": (
+        lambda rows: (make_subprojects(rows), "SP_NUMBER_TXT"),
+        s3_to_socrata.remove_dupe_rows,
+    ),
+    **{
+        f"socrata_transform[{dataset}]": (
+            lambda rows, dataset=dataset: (
+                GENERATORS[SOCRATA_DATASETS[dataset]["record_type"]](rows),
+                SOCRATA_DATASETS[dataset],
+            ),
+            s3_to_socrata.transform,
+        )
+        for dataset in SOCRATA_DATASETS
+    },
+    **{
+        f"fileobj[{record_type}]": (
+            setup_fileobj(record_type),
+            lambda fileobj, data: fileobj(data),
+        )
+        for record_type in GENERATORS
+    },
+}
+
+
+def measure(setup, run, rows, repeat=1):
+    """Return the best time in seconds, and the peak memory in bytes allocated, of
+    `repeat` runs of a suite case. Memory is measured in a separate run, because
+    tracing allocations slows everything down. Each run gets fresh input, as some
+    functions modify their input in place."""
+    seconds = None
+    for _ in range(repeat):
+        run_args = setup(rows)
+        gc.collect()
+        start = time.perf_counter()
+        result = run(*run_args)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+        del run_args, result
+
+    run_args = setup(rows)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = run(*run_args)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak_bytes
+
+
+def compare_results(results, baseline, tolerance):
+    """Log each result which is slower, or uses more memory, than its baseline by
+    more than `tolerance` (a fraction). Returns the number of regressions."""
+    baseline_index = {(res["case"], res["rows"]): res for res in baseline["results"]}
+    regressions = 0
+    for res in results:
+        base = baseline_index.get((res["case"], res["rows"]))
+        if not base:
+            continue
+        for key in ("seconds", "peak_bytes"):
+            if res[key] > base[key] * (1 + tolerance):
+                regressions += 1
+                logging.warning(
+                    f"regression: {res['case']} at {res['rows']} rows, {key} {base[key]} -> {res[key]}"
+                )
+    return regressions
+
+
+def bench_suite(args):
+    """Run every case of the suite (or those named by --cases) at each size, and
+    optionally save the results to --output and compare them to --baseline"""
+    cases = [
+        name
+        for name in SUITE
+        if not args.cases or name in args.cases or name.split("[")[0] in args.cases
+    ]
+    results = []
+    for rows in args.rows or [1000, 10000, 100000, 1000000]:
+        for name in cases:
+            setup, run = SUITE[name]
+            seconds, peak_bytes = measure(setup, run, rows, repeat=args.repeat)
+            results.append(
+                {"case": name, "rows": rows, "seconds": seconds, "peak_bytes": peak_bytes}
+            )
+            logging.info(
+                f"{name}: {rows} rows, {seconds:.3f}s, {seconds / rows * 1e6:.2f}us per row, peak {peak_bytes / 1024 ** 2:.1f}MB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(
+                {
+                    "created": arrow.utcnow().isoformat(),
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                fout,
+                indent=2,
+            )
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f"{regressions} regression(s) against {args.baseline}")
+
+
+BENCHMARKS = {
+    "coalesce_records": bench_coalesce_records,
+    "create_mapped_record": bench_create_mapped_record,
+    "handle_records": bench_handle_records,
+    "pipeline_memory": bench_pipeline_memory,
+    "remove_dupe_rows": bench_remove_dupe_rows,
+    "socrata_transform": bench_socrata_transform,
+    "suite": bench_suite,
+}
+
+
+def cli_args():
+    parser = argparse.ArgumentParser(description="Benchmark the ETL transforms")
+    parser.add_argument(
+        "name",
+        type=str,
+        choices=list(BENCHMARKS.keys()),
+        help="The name of the benchmark to run.",
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        help="The number(s) of synthetic source records to benchmark with.",
+    )
+    parser.add_argument(
+        "--legacy-rows",
+        type=int,
+        help="The most records to time with a legacy implementation before extrapolating.",
+    )
+    parser.add_argument(
+        "--cases",
+        type=str,
+        nargs="+",
+        help="suite: the cases to run, e.g. `fileobj` or `fileobj[units]`. Defaults to all.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="suite: the number of timed runs of each case, of which the best is kept.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="suite: save the results to this JSON file.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="suite: a results file to compare against. Exits with an error on any regression.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="suite: the fraction by which a result may exceed its baseline.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = cli_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    main()
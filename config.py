@@ -1,6 +1,8 @@
 import arrow
 
-""" Handlers must accept and return single value """
+""" Handlers must accept and return single value. A handler whose value does not
+depend on its input can be marked `run_constant`, in which case it is evaluated once
+per run rather than once per record."""
 
 
 def pad_angle_brackets(value):
@@ -42,6 +44,10 @@ def stringify_value(value):
     """Changes a given value to be stored as a string"""
     return str(value)
 
+def task_order_display_name(row):
+    """Derives a task order's display name from its renamed columns"""
+    return row["TASK_ORDER"] + " | " + row["NAME"]
+
 """
 Each top level key must be a financial record type. you probably dont want to mess w/
 these. To add additional destination apps, follow the pattern used with
@@ -57,6 +63,8 @@ FIELD_MAPS = {
         },
         # see docstring about coalesce in s3_to_knack.py
         "coalesce_fields": ["BYR_FDU"],
+        # coalesced values are sorted into a consistent order (see string_list_order)
+        "coalesce_sort": True,
         "field_map": [
             {
                 "src": "TASK_ORDER_DEPT",
@@ -112,7 +120,6 @@ FIELD_MAPS = {
                 "src": "BYR_FDU",
                 "data-tracker": "field_3807",
                 "finance-purchasing": "field_998",
-                "handler": string_list_order,
             },
             {
                 # appends modified date
@@ -121,6 +128,7 @@ FIELD_MAPS = {
                 "finance-purchasing": "field_999",
                 "handler": knack_current_timestamp,
                 "ignore_diff": True,
+                "run_constant": True,
             },
         ],
     },
@@ -259,3 +267,52 @@ FIELD_MAPS = {
         ],
     },
 }
+
+"""
+Each top level key is a Socrata dataset published by s3_to_socrata.py. A dataset is
+published from the S3 file of its financial `record_type`, to the Socrata dataset
+whose ID is held in the `dataset_id_env` environmental variable. `row_id` must be
+the Socrata dataset's row identifier. The optional transforms are applied in order:
+`columns` renames and selects the source columns, `derived` adds columns computed
+from each renamed row, `forbidden_keys` are removed, and rows are deduplicated on
+`dedupe_key`. `dedupe_policy` chooses which duplicate row is kept: "keep-first" (the
+default), "keep-last", or "error", which fails the dataset if any duplicate differs
+from the first row.
+"""
+SOCRATA_DATASETS = {
+    "task_orders": {
+        "record_type": "task_orders",
+        "dataset_id_env": "TASK_DATASET",
+        "row_id": "TASK_ORDER",
+        "columns": {
+            "TASK_ORDER_DEPT": "DEPT",
+            "TASK_ORDER_ID": "TASK_ORDER",
+            "TASK_ORDER_DESC": "NAME",
+            "TASK_ORDER_STATUS": "Status",
+            "TASK_ORDER_TYPE": "TK_TYPE",
+            "TK_CURR_AMOUNT": "CURRENT_ESTIMATE",
+            "CHARGED_AMOUNT": "CHARGEDAMOUNT",
+            "TASK_ORDER_BAL": "BALANCE",
+            "BYR_FDU": "BUYER_FDUS",
+        },
+        "derived": {"DISPLAY_NAME": task_order_display_name},
+    },
+    "dept_units": {
+        "record_type": "units",
+        "dataset_id_env": "DEPT_UNITS_DATASET",
+        "row_id": "DEPT_UNIT_ID",
+    },
+    "fdus": {
+        "record_type": "fdus",
+        "dataset_id_env": "FDU_DATASET",
+        "row_id": "FDU_ID",
+    },
+    "subprojects": {
+        "record_type": "subprojects",
+        "dataset_id_env": "SUBPROJECTS_DATASET",
+        "row_id": "SP_NUMBER_TXT",
+        "forbidden_keys": ["SUB_PROJECT_LAST_UPDATE_BY", "SUB_PROJECT_MANAGER"],
+        "dedupe_key": "SP_NUMBER_TXT",
+        "dedupe_policy": "keep-first",
+    },
+}
@@ -0,0 +1,123 @@
+"""
+A store of record fingerprints for s3_to_knack.py.
+
+For each record in a Knack object, the store holds the Knack record ID and a hash of
+the record's diffable field values, as last written to (or read from) Knack. This
+lets s3_to_knack.py find new and changed records without downloading the Knack
+object. The store is a JSON file, kept in S3 or on local disk, per record type and
+destination app:
+
+    {
+        "reconciled": "2023-01-01T00:00:00+00:00",
+        "records": {"<primary key>": ["<knack record id>", "<hash>"], ...}
+    }
+
+`reconciled` is the last time the store was rebuilt from a full read of the Knack
+object, which catches any drift, e.g. records that were edited or deleted in Knack.
+
+Orphaned records (which are no longer in the source data) which have been
+deactivated hold `DEACTIVATED` in place of their hash.
+"""
+import hashlib
+import json
+
+import arrow
+
+import s3_cache
+
+DEACTIVATED = "deactivated"
+
+
+def fingerprint(record, compare_keys):
+    """ return a stable hash of the values of a record's compare_keys """
+    values = json.dumps([record.get(key) for key in compare_keys], default=str)
+    return hashlib.sha256(values.encode()).hexdigest()
+
+
+def store_name(record_type, app_name):
+    return f"fingerprints/{app_name}/{record_type}.json"
+
+
+def load(client, record_type, app_name, *, bucket_name=None, directory=None):
+    """Load a fingerprint store from local disk, if `directory` is given, or from
+    S3. Returns None if the store does not exist."""
+    return s3_cache.load_json(
+        client,
+        store_name(record_type, app_name),
+        bucket_name=bucket_name,
+        directory=directory,
+    )
+
+
+def save(client, store, record_type, app_name, *, bucket_name=None, directory=None):
+    """ save a fingerprint store to local disk, if `directory` is given, or to S3 """
+    s3_cache.save_json(
+        client,
+        store,
+        store_name(record_type, app_name),
+        bucket_name=bucket_name,
+        directory=directory,
+    )
+
+
+def is_stale(store, max_age_days):
+    """ check if the store has not been reconciled with Knack for `max_age_days` """
+    reconciled = arrow.get(store["reconciled"])
+    return reconciled < arrow.utcnow().shift(days=-max_age_days)
+
+
+def build(
+    diff,
+    written,
+    failed,
+    knack_pk,
+    compare_keys,
+    previous=None,
+    deactivated=(),
+    deleted=(),
+):
+    """Build the fingerprint records after a sync
+
+    Args:
+        diff (dict): The diff of the sync, from s3_to_knack.diff_records or
+            s3_to_knack.diff_fingerprints
+        written (list): (record, response data) for each record written to Knack
+        failed (list): (record, exception) for each record which failed
+        knack_pk (str): The primary key field name in the destination app
+        compare_keys (list): The field names which are compared when diffing
+        previous (dict, optional): The previous fingerprint records. Entries for
+            orphaned records are carried over from here when given, otherwise they
+            are fingerprinted from the orphaned Knack records.
+        deactivated (set, optional): The primary keys (as strings) of orphaned
+            records which are inactive
+        deleted (set, optional): The primary keys (as strings) of orphaned records
+            which were deleted, and are left out of the store
+
+    Returns:
+        dict: The knack record ID and hash of each primary key
+    """
+    # primary keys are stored as strings, because they are JSON object keys
+    records = {}
+    for rec in diff["orphaned"]:
+        pk = str(rec[knack_pk])
+        if pk in deleted:
+            continue
+        if pk in deactivated:
+            records[pk] = [rec["id"], DEACTIVATED]
+        elif previous is not None:
+            records[pk] = previous[pk]
+        else:
+            records[pk] = [rec["id"], fingerprint(rec, compare_keys)]
+    for rec in diff["unchanged"]:
+        records[str(rec[knack_pk])] = [rec["id"], fingerprint(rec, compare_keys)]
+    for rec, data in written:
+        records[str(rec[knack_pk])] = [
+            data.get("id", rec.get("id")),
+            fingerprint(rec, compare_keys),
+        ]
+    for rec, _ in failed:
+        # a failed update must be retried as an update. a failed create is left out
+        # of the store so that it is created next time.
+        if rec.get("id"):
+            records[str(rec[knack_pk])] = [rec["id"], None]
+    return records
@@ -0,0 +1,321 @@
+"""
+Concurrent, rate-limited access to the Knack API.
+
+Knack limits each app to a handful of API requests per second, so every request
+sent from here first takes a token from a shared bucket. Records are read a page at
+a time with the pages fetched concurrently, and written a record at a time. Set `KNACK_API_URL` to
+point these utilities at a local fake Knack server for testing.
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+import requests
+import urllib3
+
+KNACK_API_URL = os.getenv("KNACK_API_URL", "https://api.knack.com/v1")
+
+# requests per second allowed by Knack for a single app
+RATE_LIMIT = 10
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# a request which is not idempotent (a create) is only retried when the server
+# cannot have acted on it: when it was rate limited or the server was unavailable
+NON_IDEMPOTENT_RETRY_STATUS_CODES = (429, 503)
+
+# the largest page of records the Knack API will return
+ROWS_PER_PAGE = 1000
+
+
+class TokenBucket:
+    """A thread-safe token bucket. `take()` blocks until a token is available.
+
+    Args:
+        rate (float): The number of tokens added to the bucket per second
+        capacity (int, optional): The maximum number of tokens held by the bucket,
+            i.e. the largest allowed burst. Defaults to `rate`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_session(app_id, api_key, pool_size=10):
+    """ return a requests session with Knack auth headers """
+    session = requests.Session()
+    session.headers.update(
+        {
+            "X-Knack-Application-Id": app_id,
+            "X-Knack-REST-API-Key": api_key,
+            "Content-Type": "application/json",
+        }
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def is_connect_error(error):
+    """ check if a request failed while connecting, before it reached the server """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def send(
+    session,
+    bucket,
+    method,
+    url,
+    *,
+    max_attempts=5,
+    backoff=1,
+    timeout=30,
+    idempotent=True,
+    **kwargs,
+):
+    """Send a request once the rate limit allows it. 429 and 5xx responses, as well
+    as connection errors and timeouts, are retried with exponential backoff.
+
+    A request which is not `idempotent` may already have been acted on when its
+    response is a 500, 502 or 504, or when it times out or the connection drops, so
+    it is only retried on 429 and 503 responses and on errors while connecting.
+
+    Returns:
+        requests.Response: The successful response
+
+    Raises:
+        requests.RequestException: If the request fails with a non-retryable status,
+            or if it is still failing after `max_attempts`
+    """
+    retry_status_codes = (
+        RETRY_STATUS_CODES if idempotent else NON_IDEMPOTENT_RETRY_STATUS_CODES
+    )
+    attempt = 1
+    while True:
+        bucket.take()
+        try:
+            res = session.request(method, url, timeout=timeout, **kwargs)
+            if res.status_code not in retry_status_codes:
+                res.raise_for_status()
+                return res
+            error = requests.HTTPError(
+                f"{res.status_code} response from {url}", response=res
+            )
+            # knack tells us how long to back off when we exceed the rate limit
+            retry_after = res.headers.get("Retry-After")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not (idempotent or is_connect_error(e)):
+                raise
+            error = e
+            retry_after = None
+        if attempt >= max_attempts:
+            raise error
+        delay = backoff * 2 ** (attempt - 1)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        logging.debug(f"Retrying {method} {url} in {delay}s: {error}")
+        time.sleep(delay)
+        attempt += 1
+
+
+def get_page(session, bucket, obj, page, url=KNACK_API_URL, rows_per_page=ROWS_PER_PAGE):
+    """ return the response data of a single page of an object's records """
+    res = send(
+        session,
+        bucket,
+        "GET",
+        f"{url}/objects/{obj}/records",
+        params={"page": page, "rows_per_page": rows_per_page},
+    )
+    return res.json()
+
+
+def project_record(record, fields):
+    """Reduce a record from the Knack API to its `id` and the raw value of each of
+    `fields`. As in knackpy, empty strings and lists are replaced with None. Unlike
+    knackpy, timestamps are not corrected for the app's timezone."""
+    projected = {"id": record["id"]}
+    for key in fields:
+        val = record.get(f"{key}_raw", record.get(key))
+        projected[key] = None if val == "" or val == [] else val
+    return projected
+
+
+def read_records(
+    obj,
+    fields,
+    *,
+    app_id,
+    api_key,
+    workers=8,
+    rate=RATE_LIMIT,
+    url=KNACK_API_URL,
+    rows_per_page=ROWS_PER_PAGE,
+):
+    """Read all records of a Knack object. The first page tells us how many pages
+    there are, and the rest are fetched concurrently. The Knack API always returns
+    every field, so the records are projected to the given fields as each page
+    arrives.
+
+    Args:
+        obj (str): The Knack object key, e.g. "object_86"
+        fields (list): The field keys to keep, e.g. ["field_1276"]
+        app_id (str): The Knack app ID
+        api_key (str): The Knack API key
+        workers (int, optional): The number of concurrent requests. Defaults to 8.
+        rate (float, optional): The maximum requests per second. Defaults to
+            RATE_LIMIT.
+        url (str, optional): The Knack API base url. Defaults to KNACK_API_URL.
+        rows_per_page (int, optional): Defaults to ROWS_PER_PAGE.
+
+    Returns:
+        list: The projected records, in page order
+    """
+    session = get_session(app_id, api_key, pool_size=workers)
+    bucket = TokenBucket(rate)
+    start = time.monotonic()
+
+    def read_page(page):
+        # the unprojected page is dropped as soon as it has been projected
+        data = get_page(session, bucket, obj, page, url, rows_per_page)
+        records = [project_record(record, fields) for record in data["records"]]
+        return int(data.get("total_pages") or 1), records
+
+    total_pages, records = read_page(1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for _, page_records in executor.map(read_page, range(2, total_pages + 1)):
+            records += page_records
+
+    elapsed = time.monotonic() - start
+    logging.info(
+        f"{len(records)} record(s) read from {total_pages} page(s) in {elapsed:.1f}s"
+    )
+    return records
+
+
+def write_record(session, bucket, record, obj, url=KNACK_API_URL):
+    """ create or update a single record, depending on whether it has an `id` """
+    if not record.get("id"):
+        # a retried create could create a duplicate record
+        res = send(
+            session,
+            bucket,
+            "POST",
+            f"{url}/objects/{obj}/records",
+            json=record,
+            idempotent=False,
+        )
+    else:
+        res = send(
+            session,
+            bucket,
+            "PUT",
+            f"{url}/objects/{obj}/records/{record['id']}",
+            json=record,
+        )
+    return res.json()
+
+
+def delete_record(session, bucket, record, obj, url=KNACK_API_URL):
+    """ delete a single record by its `id` """
+    res = send(
+        session, bucket, "DELETE", f"{url}/objects/{obj}/records/{record['id']}"
+    )
+    return res.json()
+
+
+def process_records(
+    records,
+    obj,
+    request,
+    *,
+    app_id,
+    api_key,
+    workers=8,
+    rate=RATE_LIMIT,
+    url=KNACK_API_URL,
+):
+    """Send a request for each record in a Knack object with a pool of workers. A
+    failed record does not stop the others from being processed.
+
+    Args:
+        records (list): The record payloads
+        obj (str): The Knack object key, e.g. "object_86"
+        request (function): Sends the request for a single record, e.g.
+            `write_record`
+        app_id (str): The Knack app ID
+        api_key (str): The Knack API key
+        workers (int, optional): The number of concurrent requests. Defaults to 8.
+        rate (float, optional): The maximum requests per second. Defaults to
+            RATE_LIMIT.
+        url (str, optional): The Knack API base url. Defaults to KNACK_API_URL.
+
+    Returns:
+        tuple: A list of (record, response data) for each record processed, and a
+            list of (record, exception) for each record which failed.
+    """
+    session = get_session(app_id, api_key, pool_size=workers)
+    bucket = TokenBucket(rate)
+    done = []
+    failed = []
+    start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(request, session, bucket, record, obj, url): record
+            for record in records
+        }
+        for future in concurrent.futures.as_completed(futures):
+            record = futures[future]
+            try:
+                done.append((record, future.result()))
+            except requests.RequestException as e:
+                failed.append((record, e))
+            count = len(done) + len(failed)
+            if count % 100 == 0:
+                logging.info(f"{count} record(s) processed")
+
+    elapsed = time.monotonic() - start
+    rate_achieved = len(records) / elapsed if elapsed else 0
+    logging.info(
+        f"{len(done)} record(s) processed, {len(failed)} failed in {elapsed:.1f}s ({rate_achieved:.1f} records/sec)"
+    )
+    return done, failed
+
+
+def write_records(records, obj, **kwargs):
+    """Create or update records in a Knack object with a pool of workers. Records
+    with an `id` are updated, the others are created. See `process_records` for the
+    arguments and return value."""
+    return process_records(records, obj, write_record, **kwargs)
+
+
+def delete_records(records, obj, **kwargs):
+    """Delete records, by their `id`, from a Knack object with a pool of workers. See
+    `process_records` for the arguments and return value."""
+    return process_records(records, obj, delete_record, **kwargs)
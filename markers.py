@@ -0,0 +1,91 @@
+"""
+Last-processed markers for s3_to_knack.py and s3_to_socrata.py.
+
+After a successful run, a job saves a marker holding the checksum of the snapshot it
+processed (see upload_to_s3.upload_snapshot) and a hash of the config it processed
+it with. A later run can skip a snapshot and config it has already processed, which
+on most nights makes the whole pipeline a no-op. Markers are JSON files, kept in S3
+or on local disk, per job and destination:
+
+    {
+        "checksum": "<snapshot checksum>",
+        "config": "<config hash>",
+        "processed": "2023-01-01T00:00:00+00:00"
+    }
+"""
+import hashlib
+import inspect
+import json
+
+import arrow
+
+import s3_cache
+
+
+def code_values(code):
+    """ return the bytecode, constants and names of a code object, and of the code it nests """
+    consts = [
+        code_values(const) if inspect.iscode(const) else repr(const)
+        for const in code.co_consts
+    ]
+    return [code.co_code.hex(), consts, code.co_names]
+
+
+def function_source(func):
+    """Return the source code and bytecode of a config function (e.g. a field
+    handler), so that a change to its body changes the config hash. The bytecode
+    tells apart functions whose source is not available, or lambdas which share a
+    line."""
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return str(func)
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = None
+    return [source, code_values(code)]
+
+
+def config_hash(config):
+    """ return a stable hash of a config, including the code of its functions """
+    values = json.dumps(config, sort_keys=True, default=function_source)
+    return hashlib.sha256(values.encode()).hexdigest()
+
+
+def marker_name(job, name):
+    return f"markers/{job}/{name}.json"
+
+
+def load(client, job, name, *, bucket_name=None, directory=None):
+    """Load a marker from local disk, if `directory` is given, or from S3. Returns
+    None if the marker does not exist."""
+    return s3_cache.load_json(
+        client, marker_name(job, name), bucket_name=bucket_name, directory=directory
+    )
+
+
+def save(client, marker, job, name, *, bucket_name=None, directory=None):
+    """ save a marker to local disk, if `directory` is given, or to S3 """
+    s3_cache.save_json(
+        client, marker, marker_name(job, name), bucket_name=bucket_name, directory=directory
+    )
+
+
+def build(checksum, config):
+    return {
+        "checksum": checksum,
+        "config": config_hash(config),
+        "processed": arrow.utcnow().isoformat(),
+    }
+
+
+def is_current(marker, checksum, config, max_age_days=None):
+    """Check if a marker is for the given snapshot checksum and config. A marker
+    older than `max_age_days` is never current, so that the snapshot is processed
+    again from time to time."""
+    if not marker or not checksum:
+        return False
+    if max_age_days is not None:
+        if arrow.get(marker["processed"]) < arrow.utcnow().shift(days=-max_age_days):
+            return False
+    return marker.get("checksum") == checksum and marker["config"] == config_hash(config)
@@ -0,0 +1,164 @@
+"""
+Per-stage timing and throughput metrics for the ETL scripts.
+
+Each stage of a job (query, fetch, serialize, upload, download, parse, transform,
+diff, write) is timed with `Metrics.stage()`, along with the number of rows and bytes
+it processed. Every stage is logged to stdout as a single line of JSON. Metrics can
+also be sent to:
+
+- a Prometheus textfile, for the node exporter's textfile collector, if
+  `METRICS_TEXTFILE_DIR` is set to the collector's directory. Each job run writes its
+  own file, named after the job and its labels, e.g.
+  `atd_finance_s3_to_knack_task_orders_data-tracker.prom`.
+- StatsD, if `STATSD_HOST` is set (`STATSD_PORT` defaults to 8125). StatsD has no
+  labels, so their values are part of each metric's name, between the job and the
+  stage, e.g. `atd_finance.s3_to_knack.task_orders.data-tracker.write.seconds`.
+"""
+import contextlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+import utils
+
+METRICS_TEXTFILE_DIR = os.getenv("METRICS_TEXTFILE_DIR")
+STATSD_HOST = os.getenv("STATSD_HOST")
+STATSD_PORT = int(os.getenv("STATSD_PORT", 8125))
+
+PREFIX = "atd_finance"
+# characters which may not appear in a StatsD metric name
+STATSD_INVALID_CHARS = re.compile(r"[^A-Za-z0-9_-]")
+
+
+class Metrics:
+    """Collects the metrics of each stage of a job.
+
+    Args:
+        job (str): The job name, e.g. "s3_to_knack"
+        labels (dict, optional): Labels which apply to every stage, e.g. the record
+            type
+        textfile_dir (str, optional): The Prometheus textfile directory. Defaults
+            to METRICS_TEXTFILE_DIR.
+        statsd_host (str, optional): The StatsD host. Defaults to STATSD_HOST.
+        statsd_port (int, optional): The StatsD port. Defaults to STATSD_PORT.
+    """
+
+    def __init__(
+        self,
+        job,
+        labels=None,
+        textfile_dir=METRICS_TEXTFILE_DIR,
+        statsd_host=STATSD_HOST,
+        statsd_port=STATSD_PORT,
+    ):
+        self.job = job
+        self.labels = labels or {}
+        self.textfile_dir = textfile_dir
+        self.statsd = (statsd_host, statsd_port) if statsd_host else None
+        self.stages = []
+        self.lock = threading.Lock()
+        self.logger = utils.get_logger(f"metrics.{job}", logging.INFO, fmt="%(message)s")
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        """Time a stage. The context manager yields a dict in which the stage may
+        record the `rows` and `bytes` it processed.
+
+        Example:
+            with metrics.stage("download") as stage:
+                data = download()
+                stage["rows"] = len(data)
+        """
+        counts = {"rows": None, "bytes": None}
+        start = time.monotonic()
+        try:
+            yield counts
+        finally:
+            self.record(
+                name,
+                time.monotonic() - start,
+                rows=counts["rows"],
+                nbytes=counts["bytes"],
+                **labels,
+            )
+
+    def record(self, name, seconds, rows=None, nbytes=None, **labels):
+        """ record a stage which was timed elsewhere """
+        stage = {
+            "job": self.job,
+            "stage": name,
+            **self.labels,
+            **labels,
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "bytes": nbytes,
+        }
+        if seconds:
+            if rows is not None:
+                stage["rows_per_sec"] = round(rows / seconds, 1)
+            if nbytes is not None:
+                stage["bytes_per_sec"] = round(nbytes / seconds, 1)
+        with self.lock:
+            self.stages.append(stage)
+        self.logger.info(json.dumps(stage))
+        if self.statsd:
+            self.send_statsd(stage)
+
+    def send_statsd(self, stage):
+        """ send a stage's metrics to StatsD over UDP """
+        label_values = [
+            STATSD_INVALID_CHARS.sub("_", str(val))
+            for label, val in stage.items()
+            if label not in ("job", "stage", "seconds", "rows", "bytes")
+            and not label.endswith("_per_sec")
+        ]
+        name = ".".join([PREFIX, self.job, *label_values, stage["stage"]])
+        lines = [f"{name}.seconds:{stage['seconds'] * 1000:.0f}|ms"]
+        for key in ("rows", "bytes"):
+            if stage[key] is not None:
+                lines.append(f"{name}.{key}:{stage[key]}|g")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                sock.sendto("\n".join(lines).encode(), self.statsd)
+            except OSError as e:
+                # metrics must never break the job
+                self.logger.warning(f"Unable to send metrics to StatsD: {e}")
+
+    def write_textfile(self):
+        """Write the metrics of every stage to the job's Prometheus textfile. Stages
+        with the same labels are summed. The file is replaced atomically, so the
+        collector never reads a partial file."""
+        if not self.textfile_dir:
+            return
+        series = {}
+        for stage in self.stages:
+            labels = tuple(
+                (label, val)
+                for label, val in stage.items()
+                if label not in ("seconds", "rows", "bytes")
+                and not label.endswith("_per_sec")
+            )
+            totals = series.setdefault(labels, {})
+            for key in ("seconds", "rows", "bytes"):
+                if stage[key] is not None:
+                    totals[key] = totals.get(key, 0) + stage[key]
+
+        lines = []
+        for key in ("seconds", "rows", "bytes"):
+            metric = f"{PREFIX}_stage_{key}"
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, totals in series.items():
+                if key in totals:
+                    label_str = ",".join(f'{label}="{val}"' for label, val in labels)
+                    lines.append(f"{metric}{{{label_str}}} {totals[key]}")
+        name = "_".join([PREFIX, self.job, *map(str, self.labels.values())])
+        path = os.path.join(self.textfile_dir, f"{name}.prom")
+        # the collector ignores files which do not end in .prom
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fout:
+            fout.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
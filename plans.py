@@ -0,0 +1,105 @@
+"""
+Sync plans for s3_to_knack.py.
+
+`s3_to_knack.py --plan` downloads, maps and diffs the records as usual, but rather
+than writing to Knack it logs the creates and updates it would make, along with an
+estimate of the API calls and time they would take. The plan can be saved to a JSON
+file, which a later `--apply` run writes to Knack without downloading or diffing
+anything:
+
+    {
+        "record_type": "task_orders",
+        "app_name": "data-tracker",
+        "knack_object": "object_86",
+        "knack_pk": "field_1277",
+        "planned": "2023-01-01T00:00:00+00:00",
+        "counts": {"create": 1, "update": 1, "unchanged": 10, "orphaned": 0},
+        "estimate": {"api_calls": 2, "seconds": 0.2},
+        "changes": {"<primary key>": ["<knack field>", ...]},
+        "todos": [<record payload>, ...]
+    }
+
+`changes` holds the fields which differ for each update. It is only known when the
+plan was diffed against the Knack records rather than the fingerprint store.
+"""
+import json
+import logging
+
+import arrow
+
+
+def estimate(api_calls, rate):
+    """Estimate the time needed to make `api_calls` at `rate` requests per second.
+    This is a lower bound, as it assumes that the rate limit is the bottleneck."""
+    return {"api_calls": api_calls, "seconds": round(api_calls / rate, 1)}
+
+
+def build(diff, record_type, app_name, knack_obj, knack_pk, rate):
+    """Build a plan from a diff
+
+    Args:
+        diff (dict): A diff from s3_to_knack.diff_records or diff_fingerprints
+        record_type (str): The record type name, e.g. "task_orders"
+        app_name (str): The name of the destination app
+        knack_obj (str): The Knack object key
+        knack_pk (str): The primary key field name in the destination app
+        rate (float): The maximum Knack API requests per second
+
+    Returns:
+        dict: The plan
+    """
+    return {
+        "record_type": record_type,
+        "app_name": app_name,
+        "knack_object": knack_obj,
+        "knack_pk": knack_pk,
+        "planned": arrow.utcnow().isoformat(),
+        "counts": dict(diff["counts"]),
+        "estimate": estimate(len(diff["todos"]), rate),
+        "changes": {str(pk): fields for pk, fields in diff["changes"].items()},
+        "todos": diff["todos"],
+    }
+
+
+def log(plan, field_map):
+    """ log each create and update in a plan, followed by a summary """
+    app_name = plan["app_name"]
+    knack_pk = plan["knack_pk"]
+    src_names = {field[app_name]: field["src"] for field in field_map}
+    for record in plan["todos"]:
+        pk = str(record[knack_pk])
+        if not record.get("id"):
+            logging.info(f"create {pk}")
+            continue
+        fields = plan["changes"].get(pk)
+        if fields is None:
+            # the plan was diffed against fingerprints, which do not tell us which
+            # fields have changed
+            logging.info(f"update {pk} ({record['id']})")
+        else:
+            names = ", ".join(f"{src_names.get(key) or key} ({key})" for key in fields)
+            logging.info(f"update {pk} ({record['id']}): {names}")
+    logging.info(", ".join(f"{count} {key}" for key, count in plan["counts"].items()))
+    logging.info(
+        f"{plan['estimate']['api_calls']} API call(s), estimated {plan['estimate']['seconds']}s at the configured rate limit"
+    )
+
+
+def save(plan, path):
+    with open(path, "w") as fout:
+        json.dump(plan, fout)
+
+
+def load(path, record_type, app_name):
+    """Load a plan file
+
+    Raises:
+        ValueError: If the plan was made for another record type or app
+    """
+    with open(path) as fin:
+        plan = json.load(fin)
+    if (plan["record_type"], plan["app_name"]) != (record_type, app_name):
+        raise ValueError(
+            f"{path} is a plan for {plan['record_type']} in {plan['app_name']}, not {record_type} in {app_name}"
+        )
+    return plan
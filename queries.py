@@ -105,3 +105,42 @@ QUERIES = {
         MSTR_IA_DEV.DEPT_2400_SUBPRJ_VW
 	""",
 }
+
+# Record types which can be extracted incrementally (`upload_to_s3.py --incremental`).
+# Oracle hashes the `hash_columns` of each row, so that only the primary key and hash
+# of each row has to be transferred in order to find the records which have changed.
+# Every column selected in the record type's query must be listed here, or the
+# extraction fails.
+INCREMENTAL = {
+    "task_orders": {
+        "primary_key": "TASK_ORDER_ID",
+        "hash_columns": [
+            "TASK_ORDER_DEPT",
+            "TASK_ORDER_ID",
+            "TASK_ORDER_DESC",
+            "TASK_ORDER_STATUS",
+            "TASK_ORDER_TYPE",
+            "TK_CURR_AMOUNT",
+            "CHARGED_AMOUNT",
+            "TASK_ORDER_BAL",
+            "TASK_ORDER_ESTIMATOR",
+            "BYR_FDU",
+        ],
+    },
+}
+
+# Record types which can be extracted in partitions (`upload_to_s3.py --partitioned`).
+# Each partition is a slice of the record type's query which runs on its own DB
+# session, and the rows of every partition are merged into the usual output. Every
+# row of a record should fall in the same partition. Supported schemes:
+#
+# - "hash": `partitions` slices by the hash of `column`
+# - "list": one slice for each list of `column` values in `values`, plus a slice for
+#   every other value (including nulls)
+PARTITIONS = {
+    "task_orders": {
+        "scheme": "hash",
+        "column": "TASK_ORDER_ID",
+        "partitions": 4,
+    },
+}
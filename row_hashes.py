@@ -0,0 +1,105 @@
+"""
+A store of row hashes for s3_to_socrata.py.
+
+For each row of a Socrata dataset, the store holds a hash of the row as it was last
+upserted, keyed by the dataset's row identifier. This lets s3_to_socrata.py send
+only the rows which are new or have changed, and delete the rows which are no longer
+in the source data. The store is a JSON file, kept in S3 or on local disk, per
+dataset:
+
+    {
+        "dataset_id": "abcd-1234",
+        "row_id": "TASK_ORDER",
+        "updated": "2023-01-01T00:00:00+00:00",
+        "rows": [["<row identifier>", "<hash>"], ...]
+    }
+
+`rows` is a list of pairs rather than an object, so that row identifiers keep their
+JSON type, which matters when a row is deleted by its identifier.
+"""
+import hashlib
+import json
+
+import arrow
+
+import s3_cache
+
+
+def row_hash(row):
+    """ return a stable hash of all of a row's values """
+    values = json.dumps(row, sort_keys=True, default=str)
+    return hashlib.blake2b(values.encode(), digest_size=16).hexdigest()
+
+
+def store_name(dataset):
+    return f"row_hashes/socrata/{dataset}.json"
+
+
+def load(client, dataset, *, bucket_name=None, directory=None):
+    """Load a row hash store from local disk, if `directory` is given, or from S3.
+    Returns None if the store does not exist."""
+    return s3_cache.load_json(
+        client, store_name(dataset), bucket_name=bucket_name, directory=directory
+    )
+
+
+def save(client, store, dataset, *, bucket_name=None, directory=None):
+    """ save a row hash store to local disk, if `directory` is given, or to S3 """
+    s3_cache.save_json(
+        client, store, store_name(dataset), bucket_name=bucket_name, directory=directory
+    )
+
+
+def build(data, dataset_id, row_id):
+    """ build the store of the rows which were upserted to a dataset """
+    return {
+        "dataset_id": dataset_id,
+        "row_id": row_id,
+        "updated": arrow.utcnow().isoformat(),
+        "rows": list(hash_rows(data, row_id).items()),
+    }
+
+
+def duplicate_ids(data, row_id):
+    """ return the row identifiers which appear in more than one row """
+    seen = set()
+    duplicates = set()
+    for row in data:
+        key = row[row_id]
+        if key in seen:
+            duplicates.add(key)
+        seen.add(key)
+    return sorted(duplicates, key=str)
+
+
+def hash_rows(data, row_id):
+    """Return the hash of each row identifier
+
+    Raises:
+        ValueError: If a row identifier is repeated, in which case the store cannot
+            tell the rows apart
+    """
+    hashes = {row[row_id]: row_hash(row) for row in data}
+    if len(hashes) != len(data):
+        raise ValueError(f"{row_id} is not unique, e.g. {duplicate_ids(data, row_id)[:5]}")
+    return hashes
+
+
+def diff(data, store, row_id):
+    """Find the rows which are new or have changed since the store was built
+
+    Args:
+        data (list): The current rows
+        store (dict): The row hash store
+        row_id (str): The dataset's row identifier column
+
+    Returns:
+        tuple: The rows to upsert, in their original order, and the row identifiers
+            which are in the store but no longer in the data
+    """
+    previous = dict(store["rows"])
+    current = hash_rows(data, row_id)
+    changed = {key for key, hash_ in current.items() if previous.get(key) != hash_}
+    upserts = [row for row in data if row[row_id] in changed]
+    removed = [key for key in previous if key not in current]
+    return upserts, removed
@@ -0,0 +1,364 @@
+"""
+An on-disk cache of the JSON files downloaded from S3, readers for the record
+snapshots published by upload_to_s3.py, helpers to check which objects exist, and
+helpers to load and save the small JSON state files (markers, fingerprint and row
+hash stores) which are kept in S3 or on local disk.
+
+The same file is often processed several times in a row, e.g. task_orders is
+published to data-tracker and then to finance-purchasing. Each cached file is
+revalidated against S3 with its ETag, so a cache hit costs one request and no
+transfer. The deserialized data is cached in pickle format, which also saves the
+cost of decoding the JSON. Entries are evicted, least recently used first, once
+the cache grows past its size limit.
+
+Set `S3_CACHE_DIR` to choose the cache location, or set it to an empty string to
+disable caching. `S3_CACHE_MAX_BYTES` sets the size limit. Because unpickling a file
+can run arbitrary code, the cache directory is created readable and writable only by
+its owner, and the cache is not used if the directory is owned by another user or
+others can write to it.
+"""
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pickle
+import stat
+import tempfile
+
+import botocore
+
+CACHE_DIR = os.getenv(
+    "S3_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), f"atd-finance-data-cache-{os.getuid()}"),
+)
+CACHE_MAX_BYTES = int(os.getenv("S3_CACHE_MAX_BYTES", 1024 ** 3))
+
+
+def object_metadata(res):
+    """ return the metadata of an object from a head_object or list_objects_v2 response """
+    return {
+        "size": res.get("ContentLength", res.get("Size")),
+        "etag": res["ETag"],
+        "last_modified": res["LastModified"],
+        # user metadata is only returned by head_object
+        "metadata": res.get("Metadata", {}),
+    }
+
+
+def head_objects(client, bucket, keys, max_workers=8):
+    """Check which of the given objects exist, with concurrent head_object requests.
+    This is much cheaper than listing a bucket to find a few objects.
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        bucket (str): The bucket name
+        keys (list): The object keys
+        max_workers (int, optional): The most requests to make at once
+
+    Returns:
+        dict: The metadata (size, etag, last_modified and user metadata) of each key
+            which exists
+    """
+
+    def head(key):
+        try:
+            return object_metadata(client.head_object(Bucket=bucket, Key=key))
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    keys = list(keys)
+    if not keys:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(keys))
+    ) as executor:
+        results = dict(zip(keys, executor.map(head, keys)))
+    return {key: meta for key, meta in results.items() if meta is not None}
+
+
+def list_objects(client, bucket, prefix=""):
+    """List every object under a prefix, following list_objects_v2's pages of up to
+    1000 keys
+
+    Returns:
+        dict: The metadata (size, etag and last_modified) of each key
+    """
+    objects = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for content in page.get("Contents", []):
+            objects[content["Key"]] = object_metadata(content)
+    return objects
+
+
+def get_object_or_none(client, bucket, key):
+    """ return the get_object response of an object, or None if it does not exist """
+    try:
+        return client.get_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+
+
+def load_json(client, key, *, bucket_name=None, directory=None):
+    """Load a JSON file from local disk, if `directory` is given, or from S3
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        key (str): The S3 key of the file, which is also its path in `directory`
+        bucket_name (str, optional): The bucket name
+        directory (str, optional): A local directory to use in place of S3
+
+    Returns:
+        list or dict: The deserialized content, or None if the file does not exist
+    """
+    if directory:
+        try:
+            with open(os.path.join(directory, key)) as fin:
+                return json.load(fin)
+        except FileNotFoundError:
+            return None
+    res = get_object_or_none(client, bucket_name, key)
+    return json.load(res["Body"]) if res else None
+
+
+def save_json(client, data, key, *, bucket_name=None, directory=None):
+    """ save data as a JSON file to local disk, if `directory` is given, or to S3 """
+    content = json.dumps(data)
+    if directory:
+        path = os.path.join(directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fout:
+            fout.write(content)
+        return
+    client.put_object(Bucket=bucket_name, Key=key, Body=content.encode())
+
+
+def entry_paths(cache_dir, bucket, key):
+    """ return the paths of the data and metadata files of a cache entry """
+    name = hashlib.sha256(f"{bucket}/{key}".encode()).hexdigest()
+    path = os.path.join(cache_dir, name)
+    return f"{path}.pickle", f"{path}.json"
+
+
+def write_atomic(path, data):
+    """ write a file so that concurrent readers never see a partial file """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as fout:
+        fout.write(data)
+    os.replace(tmp_path, path)
+
+
+def evict(cache_dir, max_bytes):
+    """ delete the least recently used entries until the cache fits in max_bytes """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".pickle"):
+            entry_stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        path = os.path.join(cache_dir, name[: -len(".pickle")])
+        for ext in (".pickle", ".json"):
+            try:
+                os.remove(path + ext)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def make_private_dir(path):
+    """Create a directory which only the current user can access, if it does not
+    exist, and check that an existing one is safe to load pickles from
+
+    Returns:
+        bool: True if the directory is owned by the current user and no other user
+            can write to it
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    # lstat, so that a symlink planted in place of the directory is not followed
+    path_stat = os.lstat(path)
+    return (
+        stat.S_ISDIR(path_stat.st_mode)
+        and path_stat.st_uid == os.getuid()
+        and not path_stat.st_mode & 0o022
+    )
+
+
+def get_cached(client, bucket, key, decode, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """Download a file from S3 and decode it, using the cached copy of the decoded
+    data if the file has not changed
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        bucket (str): The host bucket name
+        key (str): The file to be downloaded
+        decode (function): Decodes the file's streaming body
+        cache_dir (str, optional): The cache directory. Caching is disabled if empty.
+        max_bytes (int, optional): The cache size limit
+
+    Returns:
+        object: The decoded content
+    """
+    if not cache_dir:
+        return decode(client.get_object(Bucket=bucket, Key=key)["Body"])
+
+    if not make_private_dir(cache_dir):
+        logging.warning(
+            f"Not using the cache in {cache_dir}, which is not private to this user"
+        )
+        return get_cached(client, bucket, key, decode, cache_dir="")
+
+    data_path, meta_path = entry_paths(cache_dir, bucket, key)
+    try:
+        with open(meta_path) as fin:
+            etag = json.load(fin)["etag"]
+    except (FileNotFoundError, ValueError):
+        etag = None
+
+    kwargs = {"IfNoneMatch": etag} if etag and os.path.exists(data_path) else {}
+    try:
+        res = client.get_object(Bucket=bucket, Key=key, **kwargs)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("304", "NotModified"):
+            raise
+        try:
+            with open(data_path, "rb") as fin:
+                data_etag, data = pickle.load(fin)
+        except FileNotFoundError:
+            # the entry was evicted by another process since we checked for it
+            data_etag = None
+        if data_etag != etag:
+            # another process replaced the entry since we read its etag
+            return get_cached(client, bucket, key, decode, cache_dir="")
+        # touch the entry so that it is evicted last
+        os.utime(data_path)
+        return data
+
+    data = decode(res["Body"])
+    # the data file holds its own etag, because the two files are not written at
+    # once and may be replaced by another process in between
+    write_atomic(
+        data_path, pickle.dumps((res["ETag"], data), protocol=pickle.HIGHEST_PROTOCOL)
+    )
+    write_atomic(
+        meta_path,
+        json.dumps({"bucket": bucket, "key": key, "etag": res["ETag"]}).encode(),
+    )
+    evict(cache_dir, max_bytes)
+    return data
+
+
+def get_json(client, bucket, key, **cache_options):
+    """Download a JSON file from S3 and de-serialize it, using the cached copy if it
+    is still current
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        bucket (str): The host bucket name
+        key (str): The file to be downloaded
+        cache_options: `cache_dir` and `max_bytes` options for `get_cached`
+
+    Returns:
+        list or dict: The decoded and deserialized JSON content
+    """
+    return get_cached(client, bucket, key, json.load, **cache_options)
+
+
+def snapshot_checksum(client, bucket, name):
+    """Return the checksum of a record type's snapshot, which upload_to_s3.py stores
+    in the `checksum` metadata of the snapshot's manifest, or None"""
+    key = f"{name}.manifest.json"
+    return head_objects(client, bucket, [key]).get(key, {}).get("metadata", {}).get("checksum")
+
+
+def get_manifest(client, bucket, name):
+    """ return the manifest of a record type's compressed snapshot, or None """
+    return load_json(client, f"{name}.manifest.json", bucket_name=bucket)
+
+
+def iter_ndjson(body, manifest):
+    """Decompress and decode a gzipped NDJSON snapshot a line at a time, yielding
+    each row as it is decoded.
+
+    Raises:
+        ValueError: Once the content has been read, if it does not match the manifest
+    """
+    content_hash = hashlib.sha256()
+    count = 0
+    # each line is decoded separately, so unlike a single JSON array the rows do not
+    # share their key strings. we share them here, which saves a lot of memory.
+    keys = {}
+    for line in gzip.GzipFile(fileobj=body):
+        content_hash.update(line)
+        count += 1
+        row = json.loads(line)
+        yield {keys.setdefault(key, key): val for key, val in row.items()}
+    if count != manifest["rows"] or content_hash.hexdigest() != manifest["sha256"]:
+        raise ValueError(f"{manifest['file']} does not match its manifest")
+
+
+def decode_ndjson(body, manifest):
+    """ decode a gzipped NDJSON snapshot into a list of rows """
+    return list(iter_ndjson(body, manifest))
+
+
+def get_records(client, bucket, name, **cache_options):
+    """Download a record type's snapshot (as published by upload_to_s3.py) from S3.
+    The compressed NDJSON snapshot is used when it has a manifest, otherwise the
+    legacy JSON file is used.
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        bucket (str): The host bucket name
+        name (str): The record type name, e.g. "task_orders"
+        cache_options: `cache_dir` and `max_bytes` options for `get_cached`
+
+    Returns:
+        list: The records
+    """
+    manifest = get_manifest(client, bucket, name)
+    if manifest and manifest.get("format") == "ndjson.gz":
+        try:
+            return get_cached(
+                client,
+                bucket,
+                manifest["file"],
+                lambda body: decode_ndjson(body, manifest),
+                **cache_options,
+            )
+        except (ValueError, botocore.exceptions.ClientError) as e:
+            logging.warning(f"Falling back to {name}.json: {e}")
+    return get_json(client, bucket, f"{name}.json", **cache_options)
+
+
+def iter_records(client, bucket, name):
+    """Stream a record type's snapshot from S3, yielding each record as it is decoded,
+    so that the snapshot is never held in memory. The cache is not used. Nothing is
+    downloaded until the first record is requested.
+
+    If the compressed snapshot does not match its manifest, a ValueError is raised
+    after the last record. There is no streaming decoder for the legacy JSON file, so
+    it is decoded in full when there is no compressed snapshot.
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        bucket (str): The host bucket name
+        name (str): The record type name, e.g. "task_orders"
+
+    Yields:
+        dict: Each record
+    """
+    manifest = get_manifest(client, bucket, name)
+    if manifest and manifest.get("format") == "ndjson.gz":
+        body = client.get_object(Bucket=bucket, Key=manifest["file"])["Body"]
+        yield from iter_ndjson(body, manifest)
+    else:
+        yield from get_json(client, bucket, f"{name}.json", cache_dir="")
@@ -3,20 +3,29 @@
 # python s3_to_knack.py task_orders data-tracker
 """ Download financial data from AWS S3 and upsert to a Knack app"""
 import argparse
-import json
 import logging
 import os
 import sys
 
+import arrow
 import boto3
-import knackpy
 
 from config import FIELD_MAPS
+import fingerprints
+import knack_api
+import markers
+import metrics
+import plans
+import s3_cache
 
 BUCKET = os.getenv("BUCKET")
 KNACK_APP_ID = os.getenv("KNACK_APP_ID")
 KNACK_API_KEY = os.getenv("KNACK_API_KEY")
 
+# abort when more than this fraction of a knack object's records would be deactivated
+# or deleted, unless the record type's orphan config says otherwise
+ORPHAN_MAX_FRACTION = 0.05
+
 
 def cli_args():
     parser = argparse.ArgumentParser(
@@ -34,25 +43,96 @@ def cli_args():
         choices=["data-tracker", "finance-purchasing"],
         help="The name of the destination Knack app",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="The number of records to send to Knack concurrently",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=knack_api.RATE_LIMIT,
+        help="The maximum number of Knack API requests per second",
+    )
+    parser.add_argument(
+        "--fingerprints",
+        action="store_true",
+        help="Diff records against a store of record fingerprints instead of downloading the Knack object, when the store is available and fresh",
+    )
+    parser.add_argument(
+        "--fingerprint-dir",
+        type=str,
+        help="Keep the fingerprint store in this local directory rather than in S3",
+    )
+    parser.add_argument(
+        "--reconcile-days",
+        type=int,
+        default=7,
+        help="Rebuild the fingerprint store from Knack when it is older than this many days",
+    )
+    parser.add_argument(
+        "--full-reconcile",
+        action="store_true",
+        help="Download the Knack object and rebuild the fingerprint store",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream records from S3 through the transform and diff, rather than downloading them in full first. Bypasses the local S3 cache.",
+    )
+    parser.add_argument(
+        "--max-orphan-fraction",
+        type=float,
+        help="Override the largest fraction of the Knack records which may be deactivated or deleted as orphans",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Log the creates and updates which would be made, and an estimate of their cost, without writing to Knack",
+    )
+    parser.add_argument(
+        "--plan-file",
+        type=str,
+        help="Save the plan to this file, to be executed later with --apply",
+    )
+    parser.add_argument(
+        "--apply",
+        type=str,
+        metavar="PLAN_FILE",
+        help="Write the creates and updates of a saved plan to Knack, without downloading or diffing any records",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Process the records even if the snapshot has not changed since it was last processed",
+    )
+    parser.add_argument(
+        "--marker-dir",
+        type=str,
+        help="Keep the last-processed marker in this local directory rather than in S3",
+    )
+    args = parser.parse_args()
+    if args.plan_file and not args.plan:
+        parser.error("--plan-file requires --plan")
+    if args.apply and (args.plan or args.full_reconcile or args.stream):
+        parser.error("--apply cannot be combined with --plan, --full-reconcile or --stream")
+    return args
 
 
-def download_json(*, bucket_name, fname):
-    """Download a JSON file from S3 and de-serialize it
+def download_records(*, bucket_name, record_type):
+    """Download a record type's snapshot from S3 and de-serialize it. The compressed
+    snapshot is preferred when available, and the file is served from the local cache
+    (see s3_cache.py) if it has not changed since it was last downloaded.
 
     Args:
         bucket_name (str): The host bucket name
-        fname (str): The file to be downloaded
-        as_dict (bool, optional): If the file should be returned a dict. If true,
-            assumes file contents are json. Defaults to True.
+        record_type (str): The record type to be downloaded
 
     Returns:
-        list or dict: The decoded and deserialized JSON content
+        list: The decoded and deserialized records
     """
-    s3 = boto3.resource("s3")
-    obj = s3.Object(bucket_name, fname)
-    obj_data = obj.get()["Body"].read().decode()
-    return json.loads(obj_data)
+    return s3_cache.get_records(boto3.client("s3"), bucket_name, record_type)
 
 
 def get_pks(fields, app_name):
@@ -67,23 +147,209 @@ def get_pks(fields, app_name):
     return pk_field[0]["src"], pk_field[0][app_name]
 
 
+def get_compare_keys(field_map, app_name):
+    """ return the destination field names which are compared when diffing records """
+    return [field[app_name] for field in field_map if not field.get("ignore_diff")]
+
+
 def is_equal(rec_current, rec_knack, keys):
     tests = [rec_current[key] == rec_knack[key] for key in keys]
     return all(tests)
 
 
-def create_mapped_record(rec_current, field_map, app_name):
-    """Map the data from the current record (from the financial DB) to the destination
-    app schema """
-    mapped_record = {}
+def changed_fields(rec_current, rec_knack, keys):
+    """ return the keys whose values differ between two records """
+    return [key for key in keys if rec_current[key] != rec_knack[key]]
+
+
+def compile_field_map(field_map, app_name):
+    """Precompute the mapping of source records to the destination app schema, so
+    that the field map does not have to be read again for every record.
+
+    Fields with a `run_constant` handler are evaluated here, once, rather than for
+    each record.
+
+    Args:
+        field_map (list): A list of field mapping data (from config.py)
+        app_name (str): The name of the destination app.
+
+    Returns:
+        tuple: A template record, which holds every destination field in field map
+            order along with the run-constant values, and a tuple of (source field,
+            destination field, handler) for each of the remaining fields.
+    """
+    template = {}
+    fields = []
     for field in field_map:
-        val = rec_current.get(field["src"])
         handler_func = field.get("handler")
-        mapped_record[field[app_name]] = val if not handler_func else handler_func(val)
+        if field.get("run_constant"):
+            template[field[app_name]] = handler_func(None)
+        else:
+            template[field[app_name]] = None
+            fields.append((field["src"], field[app_name], handler_func))
+    return template, tuple(fields)
+
 
+def map_record(rec_current, transformer):
+    """Map the data from the current record (from the financial DB) to the destination
+    app schema with a transformer from `compile_field_map`"""
+    template, fields = transformer
+    # copying the template sets the field order, so that fields assigned below keep
+    # their position from the field map
+    mapped_record = template.copy()
+    for src, dest, handler_func in fields:
+        val = rec_current.get(src)
+        mapped_record[dest] = val if not handler_func else handler_func(val)
     return mapped_record
 
 
+def create_mapped_record(rec_current, field_map, app_name):
+    """Map the data from the current record (from the financial DB) to the destination
+    app schema """
+    return map_record(rec_current, compile_field_map(field_map, app_name))
+
+
+DIFF_CLASSES = ("create", "update", "unchanged", "orphaned")
+
+
+def new_diff():
+    """Return an empty diff: a list of records for each class, the creates and
+    updates in order (`todos`), the number of records in each class, and the changed
+    fields of each update by primary key (`changes`), where they are known"""
+    diff = {key: [] for key in DIFF_CLASSES}
+    diff["todos"] = []
+    diff["counts"] = dict.fromkeys(DIFF_CLASSES, 0)
+    diff["changes"] = {}
+    return diff
+
+
+def add_to_diff(diff, key, record, keep=True):
+    diff["counts"][key] += 1
+    if keep:
+        diff[key].append(record)
+    if key in ("create", "update"):
+        diff["todos"].append(record)
+
+
+def diff_records(
+    records_current, records_knack, knack_pk, field_map, app_name, keep_unchanged=True
+):
+    """Classify each current record (from the financial DB) against the data in the
+    destination Knack app.
+
+    Knack records are indexed by primary key once, so each current record is
+    classified with a single lookup rather than a scan of the whole Knack object.
+
+    Args:
+        records_current (iterable): The current records from the financial DB. This
+            is consumed in a single pass, so it may be a generator.
+        records_knack (list): The existing records in the desination knack app
+        knack_pk (str): The primary key field name in the destination app
+        field_map (list): A list of field mapping data (from config.py)
+        app_name (str): The name of the destination app.
+        keep_unchanged (bool, optional): If False, unchanged records are counted but
+            not kept, to save memory. Defaults to True.
+
+    Returns:
+        dict: Lists of mapped records keyed by class: `create` (not in Knack),
+            `update` (in Knack with different values), `unchanged`, and `orphaned`
+            (Knack records with no current record). `todos` holds the creates and
+            updates in the order of the current records, `counts` holds the
+            number of records in each class, and `changes` holds the fields which
+            differ for each update.
+    """
+    knack_index = {}
+    for rec_knack in records_knack:
+        # the first match wins, as it did when we scanned the knack records in order
+        knack_index.setdefault(rec_knack[knack_pk], rec_knack)
+
+    compare_keys = get_compare_keys(field_map, app_name)
+    transformer = compile_field_map(field_map, app_name)
+    diff = new_diff()
+    seen = set()
+
+    for rec in records_current:
+        # we create the record payload (and there by apply field mappings and
+        # handlers) before we determine if this record needs to be
+        # created/modified, this way we make sure we use apples <> apples
+        # when comparing the old vs new record
+        rec_current = map_record(rec, transformer)
+        id_ = rec_current[knack_pk]
+        seen.add(id_)
+        rec_knack = knack_index.get(id_)
+        if rec_knack is None:
+            add_to_diff(diff, "create", rec_current)
+        elif not is_equal(rec_current, rec_knack, compare_keys):
+            rec_current["id"] = rec_knack["id"]
+            add_to_diff(diff, "update", rec_current)
+            diff["changes"][id_] = changed_fields(rec_current, rec_knack, compare_keys)
+        else:
+            rec_current["id"] = rec_knack["id"]
+            add_to_diff(diff, "unchanged", rec_current, keep=keep_unchanged)
+
+    for id_, rec_knack in knack_index.items():
+        if id_ not in seen:
+            add_to_diff(diff, "orphaned", rec_knack)
+    return diff
+
+
+def diff_fingerprints(
+    records_current,
+    records_fingerprint,
+    knack_pk,
+    field_map,
+    app_name,
+    keep_unchanged=True,
+):
+    """Classify each current record (from the financial DB) against a store of
+    fingerprints of the records in the destination Knack app, without downloading
+    the Knack records.
+
+    Args:
+        records_current (iterable): The current records from the financial DB
+        records_fingerprint (dict): The Knack record ID and fingerprint of each
+            primary key (see fingerprints.py)
+        knack_pk (str): The primary key field name in the destination app
+        field_map (list): A list of field mapping data (from config.py)
+        app_name (str): The name of the destination app.
+        keep_unchanged (bool, optional): If False, unchanged records are counted but
+            not kept. Defaults to True.
+
+    Returns:
+        dict: The same classes of records as `diff_records`. Orphaned records hold
+            only their primary key and Knack record ID, and the changed fields of
+            updates are not known.
+    """
+    compare_keys = get_compare_keys(field_map, app_name)
+    transformer = compile_field_map(field_map, app_name)
+    diff = new_diff()
+    seen = set()
+
+    for rec in records_current:
+        rec_current = map_record(rec, transformer)
+        id_ = str(rec_current[knack_pk])
+        seen.add(id_)
+        entry = records_fingerprint.get(id_)
+        if entry is None:
+            add_to_diff(diff, "create", rec_current)
+            continue
+        rec_current["id"] = entry[0]
+        if entry[1] != fingerprints.fingerprint(rec_current, compare_keys):
+            add_to_diff(diff, "update", rec_current)
+        else:
+            add_to_diff(diff, "unchanged", rec_current, keep=keep_unchanged)
+
+    for id_, entry in records_fingerprint.items():
+        if id_ not in seen:
+            add_to_diff(diff, "orphaned", {knack_pk: id_, "id": entry[0]})
+    return diff
+
+
+def diff_counts(diff):
+    """ return the number of records in each class of a diff """
+    return dict(diff["counts"])
+
+
 def handle_records(records_current, records_knack, knack_pk, field_map, app_name):
     """Compare each current record (from the financial DB) to the data in the
     destination Knack app. If any values have are different, or if the record doesn't
@@ -98,29 +364,9 @@ def handle_records(records_current, records_knack, knack_pk, field_map, app_name
     Returns:
         list: A list of records to be created or updated in the destination app.
     """
-    # identify the primary key field name in the src data and the destination object
-    todos = []
-    mapped_records = [create_mapped_record(rec_current, field_map, app_name) for rec_current in records_current]
-    compare_keys = [field[app_name] for field in field_map if not field.get("ignore_diff")]
-    for rec_current in mapped_records:
-        matched = False
-        id_ = rec_current[knack_pk]
-        for rec_knack in records_knack:
-            if rec_knack[knack_pk] == id_:
-                matched = True
-                # # we create the record payload (and there by apply field mappings and
-                # # handlers) before we determine if this record needs to be
-                # # created/modified, this way we make sure we use apples <> apples
-                # # when comparing the old vs new record
-                if not is_equal(rec_current, rec_knack, compare_keys):
-                    rec_current["id"] = rec_knack["id"]
-                    todos.append(rec_current)
-
-                break
-        if not matched:
-            todos.append(rec_current)
-
-    return todos
+    diff = diff_records(records_current, records_knack, knack_pk, field_map, app_name)
+    logging.info(", ".join(f"{count} {key}" for key, count in diff_counts(diff).items()))
+    return diff["todos"]
 
 
 # for dev
@@ -134,14 +380,17 @@ def handle_records(records_current, records_knack, knack_pk, field_map, app_name
 
 
 def apply_src_data_filter(records_current, src_data_filter_func):
-    """ Filter records from financial DB """
+    """ Filter records from financial DB. The records are filtered lazily, as they
+    are consumed. """
     if not src_data_filter_func:
         return records_current
     else:
-        return list(filter(src_data_filter_func, records_current))
+        return filter(src_data_filter_func, records_current)
 
 
-def coalesce_records(records_current, coalesce_fields, current_pk, separator = ",\n"):
+def coalesce_records(
+    records_current, coalesce_fields, current_pk, separator=",\n", sort=False
+):
     """ Reduces record set by comma-joining values from the specified coalesce_fields
     that have the same primary key.
 
@@ -158,34 +407,254 @@ def coalesce_records(records_current, coalesce_fields, current_pk, separator = "
     because the buyer department can have multiple "unit" codes associated with the
     task order. These unit codes are the last four digits of the
     FDU (Fund-Department-Unit).
+
+    With `sort`, the coalesced values are also put in a consistent order. This gives
+    the same result as applying `config.string_list_order` to each coalesced value,
+    but only the values which hold more than one item are split and sorted.
     """
     index = {}
     for rec in records_current:
-        _id = rec[current_pk]
-        if _id not in index.keys():
-            index[_id] = rec
+        # a single lookup finds the record's group, or starts a new one
+        coal_record = index.setdefault(rec[current_pk], rec)
+        if coal_record is rec:
             continue
-        coal_record = index[_id]
         for field in coalesce_fields:
-            coal_val = coal_record[field]
             current_val = rec[field]
-            if coal_val and current_val:
-                coal_record[field] = separator.join([coal_val, current_val])
-            elif current_val:
-                coal_record[field] = current_val
-    return list(index.values())
+            if current_val:
+                coal_val = coal_record[field]
+                coal_record[field] = (
+                    coal_val + separator + current_val if coal_val else current_val
+                )
+    records = list(index.values())
+
+    if sort:
+        for field in coalesce_fields:
+            for rec in records:
+                val = rec[field]
+                if not isinstance(val, str):
+                    rec[field] = None
+                elif separator in val:
+                    rec[field] = separator.join(sorted(val.split(separator)))
+    return records
+
 
 def main():
     args = cli_args()
+    job_metrics = metrics.Metrics(
+        "s3_to_knack", {"record_type": args.name, "app": args.dest}
+    )
+    try:
+        sync(args, job_metrics)
+    finally:
+        job_metrics.write_textfile()
+
+
+def get_deactivate_values(orphan_config, field_map, app_name):
+    """Return the destination field values which mark a record as inactive. The
+    configured source values are mapped like a source record, with each field's
+    handler, so that they match the values which map_record writes."""
+    values = orphan_config["values"]
+    unknown = set(values) - {field["src"] for field in field_map}
+    if unknown:
+        raise ValueError(f"The orphan values {sorted(unknown)} are not in the field map")
+    transformer = compile_field_map(
+        [field for field in field_map if field["src"] in values], app_name
+    )
+    return map_record(values, transformer)
+
+
+def find_orphans(
+    diff, orphan_config, field_map, app_name, knack_pk, records_fingerprint=None
+):
+    """Find the orphaned Knack records (whose primary key is not in the source data)
+    which are to be deactivated or deleted
+
+    Args:
+        diff (dict): The diff of the sync
+        orphan_config (dict): The record type's `orphans` config (from config.py)
+        field_map (list): A list of field mapping data (from config.py)
+        app_name (str): The name of the destination app.
+        knack_pk (str): The primary key field name in the destination app
+        records_fingerprint (dict, optional): The fingerprint store records, if the
+            diff was made against the store rather than the Knack records
+
+    Returns:
+        tuple: The orphaned records which need to be handled, and the primary keys
+            (as strings) of orphaned records which are already inactive
+    """
+    if orphan_config["action"] == "delete":
+        return list(diff["orphaned"]), set()
+
+    values = get_deactivate_values(orphan_config, field_map, app_name)
+    orphans = []
+    inactive = set()
+    for rec in diff["orphaned"]:
+        pk = str(rec[knack_pk])
+        if records_fingerprint is not None:
+            # the store only holds the record ID, so we rely on its marker
+            is_inactive = records_fingerprint[pk][1] == fingerprints.DEACTIVATED
+        else:
+            is_inactive = all(rec.get(key) == val for key, val in values.items())
+        if is_inactive:
+            inactive.add(pk)
+        else:
+            orphans.append(rec)
+    return orphans, inactive
+
+
+def check_orphan_threshold(orphans, diff, max_fraction):
+    """Check if the number of orphans is suspicious, e.g. because the source data is
+    incomplete, in which case they should not be deactivated or deleted
+
+    Returns:
+        str: A description of the problem if the orphans are more than `max_fraction`
+            of the Knack records, otherwise None
+    """
+    counts = diff["counts"]
+    count_knack = counts["update"] + counts["unchanged"] + counts["orphaned"]
+    if orphans and len(orphans) > max_fraction * count_knack:
+        return f"{len(orphans)} of {count_knack} Knack records would be deactivated or deleted as orphans, which is more than the limit of {max_fraction:.0%}"
+    return None
+
+
+def handle_orphans(orphans, orphan_config, knack_obj, field_map, app_name, knack_pk, args):
+    """Deactivate or delete orphaned Knack records, as set by the record type's
+    `orphans` config
+
+    Returns:
+        tuple: The primary keys (as strings) of the records which were handled, and a
+            list of (record, exception) for each record which failed
+    """
+    action = orphan_config["action"]
+    pks = {rec["id"]: str(rec[knack_pk]) for rec in orphans}
+    if action == "deactivate":
+        values = get_deactivate_values(orphan_config, field_map, app_name)
+        payloads = [{"id": rec["id"], **values} for rec in orphans]
+        process = knack_api.write_records
+    elif action == "delete":
+        payloads = [{"id": rec["id"]} for rec in orphans]
+        process = knack_api.delete_records
+    else:
+        raise ValueError(f"Unsupported orphan action: {action}")
+
+    logging.info(f"{len(orphans)} orphaned records to {action}.")
+    done, failed = process(
+        payloads,
+        knack_obj,
+        app_id=KNACK_APP_ID,
+        api_key=KNACK_API_KEY,
+        workers=args.workers,
+        rate=args.rate,
+    )
+    for payload, error in failed:
+        logging.error(f"Failed to {action} record {pks[payload['id']]}: {error}")
+    return {pks[payload["id"]] for payload, _ in done}, failed
+
+
+def refresh_run_constants(records, field_map, app_name):
+    """ re-evaluate the run-constant fields of planned records, e.g. the modified date """
+    template, _ = compile_field_map(
+        [field for field in field_map if field.get("run_constant")], app_name
+    )
+    for record in records:
+        record.update(template)
+
+
+def raise_for_failures(failed, todos, knack_pk):
+    """ log each record which failed to write and raise if there were any """
+    if failed:
+        for record, error in failed:
+            logging.error(f"Failed to write record {record.get(knack_pk)}: {error}")
+        raise IOError(f"{len(failed)} of {len(todos)} record(s) failed to write to Knack")
+
+
+def apply_plan(args, job_metrics):
+    """Write the creates and updates of a saved plan (see plans.py) to Knack. If the
+    fingerprint store is in use, the entries of the written records are updated."""
     record_type = args.name
     app_name = args.dest
-    
-    # get the latest finance records from AWS S3
-    logging.info(f"Downloading {record_type} records from S3...")
-
-    records_current_unfiltered = download_json(
-        bucket_name=BUCKET, fname=f"{record_type}.json"
+    field_map = FIELD_MAPS[record_type]["field_map"]
+    plan = plans.load(args.apply, record_type, app_name)
+    todos = plan["todos"]
+    knack_pk = plan["knack_pk"]
+    refresh_run_constants(todos, field_map, app_name)
+    logging.info(f"Applying the plan made at {plan['planned']}: {len(todos)} records to process.")
+
+    with job_metrics.stage("write") as stage:
+        written, failed = knack_api.write_records(
+            todos,
+            plan["knack_object"],
+            app_id=KNACK_APP_ID,
+            api_key=KNACK_API_KEY,
+            workers=args.workers,
+            rate=args.rate,
+        )
+        stage["rows"] = len(written)
+
+    client = boto3.client("s3")
+    store_location = {"bucket_name": BUCKET, "directory": args.fingerprint_dir}
+    store = (
+        fingerprints.load(client, record_type, app_name, **store_location)
+        if args.fingerprints
+        else None
     )
+    if store:
+        with job_metrics.stage("save_fingerprints"):
+            # only the written records have changed since the store was saved
+            store["records"].update(
+                fingerprints.build(
+                    new_diff(),
+                    written,
+                    failed,
+                    knack_pk,
+                    get_compare_keys(field_map, app_name),
+                )
+            )
+            fingerprints.save(client, store, record_type, app_name, **store_location)
+
+    raise_for_failures(failed, todos, knack_pk)
+
+
+def sync(args, job_metrics):
+    record_type = args.name
+    app_name = args.dest
+    if args.apply:
+        apply_plan(args, job_metrics)
+        return
+
+    # skip the run if the snapshot and config are the same as when they were last
+    # processed. Knack is still reconciled every --reconcile-days, to catch any
+    # records which were edited there.
+    client = boto3.client("s3")
+    checksum = s3_cache.snapshot_checksum(client, BUCKET, record_type)
+    marker_name = f"{app_name}/{record_type}"
+    # another Knack app (e.g. a staging copy) must be synced, even if the data is
+    # unchanged
+    marker_config = {**FIELD_MAPS[record_type], "knack_app_id": KNACK_APP_ID}
+    marker_location = {"bucket_name": BUCKET, "directory": args.marker_dir}
+    if not (args.force or args.plan or args.full_reconcile):
+        marker = markers.load(client, "s3_to_knack", marker_name, **marker_location)
+        if markers.is_current(marker, checksum, marker_config, args.reconcile_days):
+            logging.info(
+                f"The {record_type} snapshot has not changed since it was last processed at {marker['processed']}. Nothing to do."
+            )
+            return
+
+    # get the latest finance records from AWS S3. when streaming, the records are
+    # downloaded and decoded lazily as they pass through the filter, coalesce, map
+    # and diff stages below, rather than being held in memory as a whole, so the
+    # download is timed as part of the diff stage.
+    if args.stream:
+        records_current_unfiltered = s3_cache.iter_records(
+            client, BUCKET, record_type
+        )
+    else:
+        logging.info(f"Downloading {record_type} records from S3...")
+        with job_metrics.stage("download") as stage:
+            records_current_unfiltered = download_records(
+                bucket_name=BUCKET, record_type=record_type
+            )
+            stage["rows"] = len(records_current_unfiltered)
     src_data_filter_func = (
         FIELD_MAPS[record_type].get("src_data_filter", {}).get(app_name)
     )
@@ -196,37 +665,173 @@ def main():
         else records_current_unfiltered
     )
 
-    # fetch the same type of records from knack
-    logging.info(f"Downloading {record_type} records from Knack...")
-
-    app = knackpy.App(app_id=KNACK_APP_ID, api_key=KNACK_API_KEY)
-    knack_obj = FIELD_MAPS[record_type]["knack_object"][app_name]
-    records_knack = [dict(record) for record in app.get(knack_obj)]
-
     logging.info(f"Transforming records...")
     field_map = FIELD_MAPS[record_type]["field_map"]
-    
+    knack_obj = FIELD_MAPS[record_type]["knack_object"][app_name]
+
     current_pk, knack_pk = get_pks(field_map, app_name)
 
     coalesce_fields = FIELD_MAPS[record_type].get("coalesce_fields")
-    
+
     if coalesce_fields:
-        records_current = coalesce_records(records_current, coalesce_fields, current_pk)
+        records_current = coalesce_records(
+            records_current,
+            coalesce_fields,
+            current_pk,
+            sort=FIELD_MAPS[record_type].get("coalesce_sort", False),
+        )
 
-    # identify new/changed records and map to destination Knack app schema
-    todos = handle_records(
-        records_current, records_knack, knack_pk, field_map, app_name
+    store_location = {"bucket_name": BUCKET, "directory": args.fingerprint_dir}
+    # unchanged records are only needed to rebuild the fingerprint store, which a
+    # plan does not do
+    keep_unchanged = (args.fingerprints or args.full_reconcile) and not args.plan
+    store = (
+        fingerprints.load(client, record_type, app_name, **store_location)
+        if args.fingerprints and not args.full_reconcile
+        else None
     )
 
+    # identify new/changed records and map to destination Knack app schema. the
+    # filter, coalesce and map stages are lazy, so they are timed as part of the diff.
+    if store and not fingerprints.is_stale(store, args.reconcile_days):
+        logging.info(f"Comparing {record_type} records to fingerprints...")
+        with job_metrics.stage("diff") as stage:
+            diff = diff_fingerprints(
+                records_current,
+                store["records"],
+                knack_pk,
+                field_map,
+                app_name,
+                keep_unchanged=keep_unchanged,
+            )
+            stage["rows"] = sum(diff_counts(diff).values())
+        reconciled = store["reconciled"]
+    else:
+        # fetch the same type of records from knack
+        logging.info(f"Downloading {record_type} records from Knack...")
+        with job_metrics.stage("download_knack") as stage:
+            records_knack = knack_api.read_records(
+                knack_obj,
+                [field[app_name] for field in field_map],
+                app_id=KNACK_APP_ID,
+                api_key=KNACK_API_KEY,
+                workers=args.workers,
+                rate=args.rate,
+            )
+            stage["rows"] = len(records_knack)
+        with job_metrics.stage("diff") as stage:
+            diff = diff_records(
+                records_current,
+                records_knack,
+                knack_pk,
+                field_map,
+                app_name,
+                keep_unchanged=keep_unchanged,
+            )
+            stage["rows"] = sum(diff_counts(diff).values())
+        reconciled = arrow.utcnow().isoformat()
+        store = None
+
+    orphan_config = FIELD_MAPS[record_type].get("orphans")
+    orphans = []
+    orphans_inactive = set()
+    orphan_breach = None
+    if orphan_config:
+        orphans, orphans_inactive = find_orphans(
+            diff,
+            orphan_config,
+            field_map,
+            app_name,
+            knack_pk,
+            records_fingerprint=store["records"] if store else None,
+        )
+        max_fraction = (
+            args.max_orphan_fraction
+            if args.max_orphan_fraction is not None
+            else orphan_config.get("max_fraction", ORPHAN_MAX_FRACTION)
+        )
+        orphan_breach = check_orphan_threshold(orphans, diff, max_fraction)
+
+    if args.plan:
+        plan = plans.build(diff, record_type, app_name, knack_obj, knack_pk, args.rate)
+        plans.log(plan, field_map)
+        if orphan_breach:
+            logging.warning(f"{orphan_breach}. The orphans would not be handled.")
+        elif orphans:
+            logging.info(
+                f"{len(orphans)} orphaned record(s) would be {orphan_config['action']}d. Orphans are not handled by --apply."
+            )
+        if args.plan_file:
+            plans.save(plan, args.plan_file)
+            logging.info(f"Plan saved to {args.plan_file}")
+        return
+
+    todos = diff["todos"]
+    logging.info(", ".join(f"{count} {key}" for key, count in diff_counts(diff).items()))
     logging.info(f"{len(todos)} records to process.")
 
-    count = 1
-    for record in todos:
-        if count % 10 == 0:
-            logging.info(f"{count} record(s) processed")
-        method = "create" if not record.get("id") else "update"
-        app.record(data=record, method=method, obj=knack_obj)
-        count += 1
+    with job_metrics.stage("write") as stage:
+        written, failed = knack_api.write_records(
+            todos,
+            knack_obj,
+            app_id=KNACK_APP_ID,
+            api_key=KNACK_API_KEY,
+            workers=args.workers,
+            rate=args.rate,
+        )
+        stage["rows"] = len(written)
+
+    orphans_handled = set()
+    orphans_failed = []
+    # when there are too many orphans, the creates and updates are still written, but
+    # the orphans are left alone and the run fails once everything else is done
+    if orphan_breach:
+        logging.error(f"{orphan_breach}. The orphans have not been handled.")
+    elif orphans:
+        with job_metrics.stage("orphans") as stage:
+            orphans_handled, orphans_failed = handle_orphans(
+                orphans, orphan_config, knack_obj, field_map, app_name, knack_pk, args
+            )
+            stage["rows"] = len(orphans_handled)
+    deleted = (
+        orphans_handled if orphan_config and orphan_config["action"] == "delete" else set()
+    )
+
+    if keep_unchanged:
+        with job_metrics.stage("save_fingerprints"):
+            records_fingerprint = fingerprints.build(
+                diff,
+                written,
+                failed,
+                knack_pk,
+                get_compare_keys(field_map, app_name),
+                previous=store["records"] if store else None,
+                deactivated=(orphans_handled - deleted) | orphans_inactive,
+                deleted=deleted,
+            )
+            fingerprints.save(
+                client,
+                {"reconciled": reconciled, "records": records_fingerprint},
+                record_type,
+                app_name,
+                **store_location,
+            )
+
+    raise_for_failures(failed, todos, knack_pk)
+    if orphans_failed:
+        raise IOError(
+            f"{len(orphans_failed)} of {len(orphans)} orphaned record(s) failed to {orphan_config['action']}"
+        )
+    if orphan_breach:
+        raise IOError(f"{orphan_breach}. The orphans have not been handled.")
+    if checksum:
+        markers.save(
+            client,
+            markers.build(checksum, marker_config),
+            "s3_to_knack",
+            marker_name,
+            **marker_location,
+        )
 
 
 if __name__ == "__main__":
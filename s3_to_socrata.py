@@ -4,13 +4,22 @@ Download finance json files from s3 bucket and publish them to Socrata
 example usage: "python s3_to_socrata.py --dataset fdus"
 """
 import argparse
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
+import time
 
 import boto3
+import requests
 import sodapy
 
+from config import SOCRATA_DATASETS
+import markers
+import metrics
+import row_hashes
+import s3_cache
 import utils
 
 AWS_ACCESS_ID = os.getenv("AWS_ACCESS_KEY_ID")
@@ -22,10 +31,14 @@ SO_TOKEN = os.getenv("SO_TOKEN")
 SO_USER = os.getenv("SO_USER")
 SO_PASS = os.getenv("SO_PASS")
 
-TASK_DATASET = os.getenv("TASK_DATASET")
-DEPT_UNITS_DATASET = os.getenv("DEPT_UNITS_DATASET")
-FDU_DATASET = os.getenv("FDU_DATASET")
-SUBPROJECTS_DATASET = os.getenv("SUBPROJECTS_DATASET")
+# the default number of rows sent per upsert request
+CHUNK_SIZE = 5000
+# in diff mode with deletes, the most rows that may be deleted from a dataset in one
+# run, as a fraction of its rows. a larger number likely points to a bad extract.
+DELETE_MAX_FRACTION = 0.05
+# a dataset is published at least this often, even if its snapshot and config have
+# not changed, e.g. to restore rows which were edited in Socrata
+MARKER_MAX_AGE_DAYS = 7
 
 
 def get_socrata_client():
@@ -38,163 +51,308 @@ def get_socrata_client():
     )
 
 
-def aws_list_files(client):
+def aws_list_files(client, prefix=""):
     """
-    Returns a list of files in an S3 bucket.
+    Returns a list of files in an S3 bucket, optionally under a prefix. Every page of
+    the listing is read, so buckets of more than 1000 files are listed in full.
     :return: object
     """
-    response = client.list_objects(
-        Bucket=BUCKET_NAME,
-    )
+    return list(s3_cache.list_objects(client, BUCKET_NAME, prefix))
 
-    file_list = []
-    for content in response.get("Contents", []):
-        file_list.append(content.get("Key"))
 
-    return file_list
+def is_retryable(error):
+    """ check if a failed request may succeed when it is retried """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and (
+        response.status_code == 429 or response.status_code >= 500
+    )
 
 
-def get_dept_unit(client, socrata_client):
+def upsert_chunked(
+    socrata_client,
+    dataset_id,
+    data,
+    chunk_size=CHUNK_SIZE,
+    checkpoint_dir=None,
+    max_attempts=5,
+    backoff=2,
+):
     """
-    Gets the units.json file and sends the data to socrata
+    Upserts data to a Socrata dataset in chunks, retrying chunks which fail with a
+    timeout, connection error, 429 or 5xx response with exponential backoff. Other
+    errors, e.g. a bad payload or bad credentials, are raised at once. When a checkpoint directory is given, the progress is saved
+    after each chunk, so that a rerun with the same data resumes after the last chunk
+    which succeeded.
 
     Parameters
     ----------
-    client : AWS Client object
-
     socrata_client : Socrata client object
+    dataset_id : str
+        The Socrata dataset ID
+    data : list
+        The rows to upsert
+    chunk_size : int
+        The number of rows to send per request
+    checkpoint_dir : str, optional
+        A directory in which to save the upsert progress
+    max_attempts : int
+        The number of times to try each chunk before giving up
+    backoff : int
+        The number of seconds to wait before the first retry of a chunk
 
     Returns
     -------
-    None.
+    dict
+        The combined upsert results of all chunks, e.g. "Rows Created".
 
     """
-    response = client.get_object(Bucket=BUCKET_NAME, Key="units.json")
-    obj_data = response.get("Body").read().decode()
-    data = json.loads(obj_data)
-
-    res = socrata_client.upsert(DEPT_UNITS_DATASET, data)
-    logger.info("Sent units data to Socrata")
-    logger.info(res)
-
+    checkpoint_path = (
+        os.path.join(checkpoint_dir, f"{dataset_id}.checkpoint.json")
+        if checkpoint_dir
+        else None
+    )
+    checkpoint = {"data_hash": None, "chunks_done": 0, "results": {}}
+    if checkpoint_path:
+        # the checkpoint only applies to a rerun with the same data. hashing the
+        # data means serializing all of it, so it is skipped without a checkpoint
+        checkpoint["data_hash"] = hashlib.sha256(json.dumps(data).encode()).hexdigest()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as fin:
+            saved = json.load(fin)
+        if saved["data_hash"] == checkpoint["data_hash"]:
+            checkpoint = saved
+            logger.info(
+                f"Resuming {dataset_id} upsert after chunk {checkpoint['chunks_done']}"
+            )
 
-def get_task_orders(client, socrata_client):
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+    for chunk_number in range(checkpoint["chunks_done"], len(chunks)):
+        attempt = 1
+        while True:
+            try:
+                res = socrata_client.upsert(dataset_id, chunks[chunk_number])
+                break
+            except requests.RequestException as e:
+                if attempt >= max_attempts or not is_retryable(e):
+                    raise
+                delay = backoff * 2 ** (attempt - 1)
+                logger.warning(
+                    f"Chunk {chunk_number + 1} of {len(chunks)} failed, retrying in {delay}s: {e}"
+                )
+                time.sleep(delay)
+                attempt += 1
+        logger.debug(f"Chunk {chunk_number + 1} of {len(chunks)}: {res}")
+
+        for key, val in res.items():
+            if isinstance(val, int):
+                checkpoint["results"][key] = checkpoint["results"].get(key, 0) + val
+        checkpoint["chunks_done"] = chunk_number + 1
+        if checkpoint_path:
+            with open(checkpoint_path, "w") as fout:
+                json.dump(checkpoint, fout)
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return checkpoint["results"]
+
+
+def check_row_id(socrata_client, dataset_id, row_id):
     """
-    Gets the task_orders.json file and sends the data to socrata
+    Checks that a dataset's configured row identifier is the Socrata dataset's row
+    identifier. Otherwise the upserts would append rows rather than update them, and
+    diff mode would update and delete the wrong rows.
 
     Parameters
     ----------
-    client : AWS Client object
-
     socrata_client : Socrata client object
+    dataset_id : str
+        The Socrata dataset ID
+    row_id : str
+        The configured row identifier column
 
-    Returns
-    -------
-    None.
+    Raises
+    ------
+    ValueError
+        If the dataset has a different row identifier, or none
 
     """
-    response = client.get_object(Bucket=BUCKET_NAME, Key="task_orders.json")
-    obj_data = response.get("Body").read().decode()
-    data = json.loads(obj_data)
-
-    # Transforms the file to fit the Socrata dataset
-    data = transform_tks(data)
-
-    res = socrata_client.upsert(TASK_DATASET, data)
-    logger.info("Sent task data to Socrata")
-    logger.info(res)
-
-
-def upsert_fdus(client, socrata_client):
+    metadata = socrata_client.get_metadata(dataset_id)
+    column_id = metadata.get("rowIdentifierColumnId")
+    field_names = [
+        column["fieldName"]
+        for column in metadata.get("columns", [])
+        if column.get("id") == column_id
+    ]
+    if not field_names:
+        raise ValueError(f"Socrata dataset {dataset_id} has no row identifier")
+    # socrata field names are the lowercase column names
+    if field_names[0].lower() != row_id.lower():
+        raise ValueError(
+            f"The row identifier of Socrata dataset {dataset_id} is {field_names[0]}, not {row_id}"
+        )
+
+
+def write_rows(
+    client,
+    socrata_client,
+    dataset,
+    dataset_id,
+    row_id,
+    data,
+    job_metrics,
+    diff=False,
+    delete=False,
+    max_delete_fraction=DELETE_MAX_FRACTION,
+    row_hash_dir=None,
+    **upsert_options,
+):
     """
-    Gets the fdus.json file and upserts data to socrata
+    Upserts rows to a Socrata dataset. In diff mode, the rows are compared to the
+    dataset's row hash store (see row_hashes.py) and only the new or changed rows are
+    sent, along with deletes for the rows which are no longer in the data if `delete`
+    is set. Every row is sent when the store does not exist. The store is saved once
+    the upsert succeeds, and not if Socrata rejected any rows, so that they are sent
+    again by the next run.
 
     Parameters
     ----------
     client : AWS Client object
     socrata_client : Socrata client object
+    dataset : str
+        The name of the dataset, a key of config.SOCRATA_DATASETS
+    dataset_id : str
+        The Socrata dataset ID
+    row_id : str
+        The dataset's row identifier column
+    data : list
+        The rows to upsert
+    job_metrics : metrics.Metrics object
+    diff : bool
+        Only send the rows which have changed since the last run
+    delete : bool
+        In diff mode, delete the rows which are no longer in the data
+    max_delete_fraction : float
+        Raise an IOError rather than delete more than this fraction of the rows
+    row_hash_dir : str, optional
+        Keep the row hash store in this local directory rather than in S3
+    upsert_options : keyword arguments passed to upsert_chunked
 
     Returns
     -------
-    None.
+    int
+        The number of rows sent to Socrata.
 
-    """
-    response = client.get_object(Bucket=BUCKET_NAME, Key="fdus.json")
-    obj_data = response.get("Body").read().decode()
-    data = json.loads(obj_data)
+    Raises
+    ------
+    ValueError
+        In diff mode, if the row identifier is not unique in the data
+    IOError
+        If Socrata rejected any rows
 
-    res = socrata_client.upsert(FDU_DATASET, data)
-    logger.info("Sent fdu to Socrata")
+    """
+    if diff:
+        # the store holds one hash per row identifier, so it can only track the
+        # rows when the identifier is unique
+        duplicates = row_hashes.duplicate_ids(data, row_id)
+        if duplicates:
+            raise ValueError(
+                f"{len(duplicates)} {row_id} values are repeated in {dataset}, e.g. {duplicates[:5]}. Publish it without --diff, or fix its row_id."
+            )
+    store_location = {"bucket_name": BUCKET_NAME, "directory": row_hash_dir}
+    store = row_hashes.load(client, dataset, **store_location) if diff else None
+    if store and (store["dataset_id"], store["row_id"]) != (dataset_id, row_id):
+        logger.info(f"The {dataset} row hash store is for another dataset, ignoring it")
+        store = None
+
+    removed = []
+    if store:
+        with job_metrics.stage("diff", dataset=dataset) as stage:
+            upserts, removed = row_hashes.diff(data, store, row_id)
+            stage["rows"] = len(data)
+        logger.info(
+            f"{dataset}: {len(upserts)} new or changed rows, {len(data) - len(upserts)} unchanged, {len(removed)} removed"
+        )
+        if delete and removed:
+            if len(removed) > max_delete_fraction * len(store["rows"]):
+                raise IOError(
+                    f"{len(removed)} of {len(store['rows'])} {dataset} rows would be deleted, which is more than the maximum fraction of {max_delete_fraction}"
+                )
+            upserts += [{row_id: key, ":deleted": True} for key in removed]
+    else:
+        if diff:
+            logger.info(f"No {dataset} row hash store found, sending every row")
+        upserts = data
+
+    with job_metrics.stage("write", dataset=dataset) as stage:
+        res = upsert_chunked(socrata_client, dataset_id, upserts, **upsert_options)
+        stage["rows"] = len(upserts)
     logger.info(res)
-
-
-def transform_tks(data):
+    if res.get("Errors"):
+        # the response does not say which rows were rejected, so none of the
+        # rows are recorded as published
+        raise IOError(f"Socrata rejected {res['Errors']} {dataset} rows")
+
+    if diff:
+        with job_metrics.stage("save_row_hashes", dataset=dataset):
+            # rows which were not deleted stay in the store, so that a later run
+            # with deletes enabled still knows to delete them
+            kept = [] if delete else removed
+            previous = dict(store["rows"]) if store else {}
+            new_store = row_hashes.build(data, dataset_id, row_id)
+            new_store["rows"] += [[key, previous[key]] for key in kept]
+            row_hashes.save(client, new_store, dataset, **store_location)
+    return len(upserts)
+
+
+def select_columns(data, columns, derived=None):
     """
-    Transforms the task_orders.json file to be in the same format as the socrata dataset
+    Renames and selects the columns of each row, then adds any derived columns
 
     Parameters
     ----------
-    data : dict
-        Json file from S3 bucket
+    data : list
+        A list of dictionaries, representing our data
+    columns : dict
+        The new name of each source column to keep. Source columns which are missing
+        from a row are set to None.
+    derived : dict, optional
+        A function of each derived column, which is passed the renamed row
 
     Returns
     -------
-    replaced_data : dict
-        Transformed file.
+    list
+        A list of dictionaries with the new columns
 
     """
-    columns = {
-        "TASK_ORDER_DEPT": "DEPT",
-        "TASK_ORDER_ID": "TASK_ORDER",
-        "TASK_ORDER_DESC": "NAME",
-        "TASK_ORDER_STATUS": "Status",
-        "TASK_ORDER_TYPE": "TK_TYPE",
-        "TK_CURR_AMOUNT": "CURRENT_ESTIMATE",
-        "CHARGED_AMOUNT": "CHARGEDAMOUNT",
-        "TASK_ORDER_BAL": "BALANCE",
-        "BYR_FDU": "BUYER_FDUS",
-    }
-
-    replaced_data = []
+    derived = derived or {}
+    new_data = []
     for row in data:
-        new_row = {}
-        for src_key, dest_key in columns.items():
-            new_row[dest_key] = row.get(src_key)
-        new_row["DISPLAY_NAME"] = new_row["TASK_ORDER"] + " | " + new_row["NAME"]
-        replaced_data.append(new_row)
-
-    return replaced_data
+        new_row = {dest_key: row.get(src_key) for src_key, dest_key in columns.items()}
+        for key, func in derived.items():
+            new_row[key] = func(new_row)
+        new_data.append(new_row)
+    return new_data
 
 
-def get_subprojects(client, socrata_client):
+def transform_tks(data):
     """
-    Gets the subprojects.json file and sends the data to socrata
+    Transforms the task_orders.json file to be in the same format as the socrata dataset
 
     Parameters
     ----------
-    client : AWS Client object
-
-    socrata_client : Socrata client object
+    data : dict
+        Json file from S3 bucket
 
     Returns
     -------
-    None.
+    replaced_data : dict
+        Transformed file.
 
     """
-    response = client.get_object(Bucket=BUCKET_NAME, Key="subprojects.json")
-    obj_data = response.get("Body").read().decode()
-    data = json.loads(obj_data)
-    data = remove_forbidden_keys(
-        data, forbidden_keys=["SUB_PROJECT_LAST_UPDATE_BY", "SUB_PROJECT_MANAGER"]
-    )
-    data = remove_dupe_rows(
-        data,
-        primary_key="SP_NUMBER_TXT",
-    )
-
-    res = socrata_client.upsert(SUBPROJECTS_DATASET, data)
-    logger.info("Sent subprojects data to Socrata")
-    logger.info(res)
+    dataset_config = SOCRATA_DATASETS["task_orders"]
+    return select_columns(data, dataset_config["columns"], dataset_config["derived"])
 
 
 def remove_forbidden_keys(data, forbidden_keys):
@@ -216,26 +374,297 @@ def remove_forbidden_keys(data, forbidden_keys):
     return new_data
 
 
-def remove_dupe_rows(data, primary_key):
+def dedupe_rows(data, primary_key, policy="keep-first"):
+    """finds and removes duplicate rows in a single pass over the data
+
+    Args:
+        data (list): A list of dictionaries, representing our data
+        primary_key (str or list): the ID field, or fields for a composite key, that
+            we are checking for dupes
+        policy (str): which row to keep when a key is duplicated: "keep-first",
+            "keep-last", or "error", which keeps the first row but raises a
+            ValueError if any duplicate differs from it
+
+    Returns:
+        tuple: A list of dictionaries, with dupe rows removed, and a dict of the
+            number of duplicate rows found for each duplicated key
+
+    """
+    if policy not in ("keep-first", "keep-last", "error"):
+        raise ValueError(f"Unknown dedupe policy: {policy}")
+
+    if isinstance(primary_key, str):
+        get_key = lambda row: row[primary_key]
+    else:
+        get_key = lambda row: tuple(row[key] for key in primary_key)
+
+    index = {}
+    dupe_counts = {}
+    for row in data:
+        key = get_key(row)
+        if key not in index:
+            index[key] = row
+            continue
+        dupe_counts[key] = dupe_counts.get(key, 0) + 1
+        if policy == "keep-last":
+            # replacing the value keeps the key's position from the first row
+            index[key] = row
+        elif policy == "error" and row != index[key]:
+            raise ValueError(f"Conflicting rows found for {primary_key} {key}")
+    return list(index.values()), dupe_counts
+
+
+def remove_dupe_rows(data, primary_key, policy="keep-first"):
     """removes duplicate rows which are sometimes returned from the views created for us
 
     Args:
-        primary_key (str): the ID field that we are checking for dupes
+        primary_key (str or list): the ID field, or fields for a composite key, that
+            we are checking for dupes
         data (list): A list of dictionaries, representing our data
+        policy (str): which row to keep for a duplicated key. see dedupe_rows
 
 
     Returns:
         list: A list of dictionaries, with dupe rows removed
 
     """
+    new_data, _ = dedupe_rows(data, primary_key, policy=policy)
+    return new_data
+
+
+def transform(data, dataset_config):
+    """
+    Applies a dataset's transforms (see config.SOCRATA_DATASETS) to its rows. The
+    renames, derived columns, forbidden keys and dedupe are fused into a single
+    pass, which builds one new dict per row, and none for rows without transforms.
 
-    ids = []
+    Parameters
+    ----------
+    data : list
+        The rows from S3
+    dataset_config : dict
+        The dataset's entry in config.SOCRATA_DATASETS
+
+    Returns
+    -------
+    tuple
+        The transformed rows, and a dict of the number of duplicate rows removed
+        for each duplicated key
+
+    """
+    columns = list((dataset_config.get("columns") or {}).items())
+    derived = list((dataset_config.get("derived") or {}).items())
+    forbidden_keys = set(dataset_config.get("forbidden_keys") or ())
+    dedupe_key = dataset_config.get("dedupe_key")
+    dedupe_policy = dataset_config.get("dedupe_policy", "keep-first")
+    if dedupe_policy not in ("keep-first", "keep-last", "error"):
+        raise ValueError(f"Unknown dedupe policy: {dedupe_policy}")
+    if not (columns or derived or forbidden_keys or dedupe_key):
+        return data, {}
+
+    # renamed columns which are forbidden are dropped once the derived columns,
+    # which may depend on them, are computed
+    forbidden_dest_keys = [
+        key
+        for key in [dest_key for _, dest_key in columns] + [key for key, _ in derived]
+        if key.upper() in forbidden_keys
+    ]
+    if isinstance(dedupe_key, str):
+        get_key = lambda row: row[dedupe_key]
+    elif dedupe_key:
+        get_key = lambda row: tuple(row[key] for key in dedupe_key)
+
+    # the position in new_data of the row kept for each dedupe key
+    index = {}
     new_data = []
+    dupe_counts = {}
+    # the source keys which are forbidden. the rows almost always share the same
+    # keys, so copying a row and dropping these is much faster than filtering each key
+    known_keys = set()
+    drop_keys = []
     for row in data:
-        if row[primary_key] not in ids:
-            ids.append(row[primary_key])
-            new_data.append(row)
-    return new_data
+        if columns:
+            new_row = {dest_key: row.get(src_key) for src_key, dest_key in columns}
+        elif forbidden_keys:
+            if not row.keys() <= known_keys:
+                known_keys.update(row.keys())
+                drop_keys = [key for key in known_keys if key.upper() in forbidden_keys]
+            new_row = dict(row)
+            for key in drop_keys:
+                new_row.pop(key, None)
+        else:
+            new_row = dict(row) if derived else row
+        for key, func in derived:
+            new_row[key] = func(new_row)
+        for key in forbidden_dest_keys:
+            del new_row[key]
+        if dedupe_key:
+            key = get_key(new_row)
+            if key in index:
+                dupe_counts[key] = dupe_counts.get(key, 0) + 1
+                if dedupe_policy == "keep-last":
+                    new_data[index[key]] = new_row
+                elif dedupe_policy == "error" and new_row != new_data[index[key]]:
+                    raise ValueError(f"Conflicting rows found for {dedupe_key} {key}")
+                continue
+            index[key] = len(new_data)
+        new_data.append(new_row)
+    return new_data, dupe_counts
+
+
+def publish(client, socrata_client, dataset, job_metrics, **write_options):
+    """
+    Downloads a dataset's records from S3, transforms them and sends them to Socrata
+
+    Parameters
+    ----------
+    client : AWS Client object
+    socrata_client : Socrata client object
+    dataset : str
+        The name of the dataset, a key of config.SOCRATA_DATASETS
+    job_metrics : metrics.Metrics object
+    write_options : keyword arguments passed to write_rows
+
+    Returns
+    -------
+    int
+        The number of rows sent to Socrata.
+
+    """
+    dataset_config = SOCRATA_DATASETS[dataset]
+    dataset_id = os.getenv(dataset_config["dataset_id_env"])
+    if not dataset_id:
+        raise ValueError(f"{dataset_config['dataset_id_env']} is not set")
+    check_row_id(socrata_client, dataset_id, dataset_config["row_id"])
+
+    with job_metrics.stage("download", dataset=dataset) as stage:
+        data = s3_cache.get_records(client, BUCKET_NAME, dataset_config["record_type"])
+        stage["rows"] = len(data)
+
+    with job_metrics.stage("transform", dataset=dataset) as stage:
+        data, dupe_counts = transform(data, dataset_config)
+        stage["rows"] = len(data)
+    if dupe_counts:
+        logger.info(
+            f"Removed {sum(dupe_counts.values())} duplicate {dataset} rows for {len(dupe_counts)} keys"
+        )
+        logger.debug(dupe_counts)
+
+    rows = write_rows(
+        client,
+        socrata_client,
+        dataset,
+        dataset_id,
+        dataset_config["row_id"],
+        data,
+        job_metrics,
+        **write_options,
+    )
+    logger.info(f"Sent {dataset} data to Socrata")
+    return rows
+
+
+def dataset_file(dataset):
+    """ return the name of the S3 file a dataset is published from """
+    return f"{SOCRATA_DATASETS[dataset]['record_type']}.json"
+
+
+def publish_dataset(
+    dataset,
+    client,
+    objects,
+    job_metrics,
+    force=False,
+    marker_dir=None,
+    marker_max_age_days=MARKER_MAX_AGE_DAYS,
+    **write_options,
+):
+    """
+    Publishes a single dataset, with its own Socrata client. Errors are logged
+    rather than raised, so that they do not stop other datasets from publishing.
+
+    The dataset is skipped if its snapshot's checksum (from the manifest's metadata)
+    and its config are the same as when it was last published, according to its
+    last-processed marker (see markers.py), and the marker is less than
+    `marker_max_age_days` old.
+
+    Parameters
+    ----------
+    dataset : str
+        The name of the dataset, a key of config.SOCRATA_DATASETS
+    client : AWS Client object
+    objects : dict
+        The metadata of the dataset files and manifests which exist in the S3
+        bucket, from s3_cache.head_objects
+    job_metrics : metrics.Metrics object
+    force : bool
+        Publish the dataset even if it has not changed
+    marker_dir : str, optional
+        Keep the last-processed markers in this local directory rather than in S3
+    marker_max_age_days : int
+        Publish the dataset when it was last published this many days ago, even if
+        it has not changed
+    write_options : keyword arguments passed to write_rows
+
+    Returns
+    -------
+    dict
+        The dataset's status, number of rows published and run time in seconds.
+
+    """
+    file_name = dataset_file(dataset)
+    start = time.monotonic()
+    # Check if the file is in S3
+    if file_name not in objects:
+        logger.info(f"No {file_name} file found in S3 Bucket, nothing happened.")
+        return {"status": "missing", "rows": 0, "seconds": 0}
+    logger.info(
+        f"Publishing {dataset} from {file_name} ({objects[file_name]['size']} bytes, modified {objects[file_name]['last_modified']})"
+    )
+    dataset_config = SOCRATA_DATASETS[dataset]
+    manifest_name = f"{dataset_config['record_type']}.manifest.json"
+    checksum = objects.get(manifest_name, {}).get("metadata", {}).get("checksum")
+    # a new Socrata dataset ID must be published to, even if the data is unchanged
+    marker_config = {
+        **dataset_config,
+        "dataset_id": os.getenv(dataset_config["dataset_id_env"]),
+    }
+    marker_location = {"bucket_name": BUCKET_NAME, "directory": marker_dir}
+    try:
+        marker = (
+            None
+            if force
+            else markers.load(client, "s3_to_socrata", dataset, **marker_location)
+        )
+        if markers.is_current(marker, checksum, marker_config, marker_max_age_days):
+            logger.info(
+                f"{file_name} has not changed since {dataset} was last published at {marker['processed']}. Skipping."
+            )
+            return {"status": "unchanged", "rows": 0, "seconds": time.monotonic() - start}
+        rows = publish(
+            client, get_socrata_client(), dataset, job_metrics, **write_options
+        )
+        if checksum:
+            markers.save(
+                client,
+                markers.build(checksum, marker_config),
+                "s3_to_socrata",
+                dataset,
+                **marker_location,
+            )
+    except Exception:
+        logger.exception(f"Failed to publish {dataset}")
+        return {"status": "failed", "rows": 0, "seconds": time.monotonic() - start}
+    return {"status": "ok", "rows": rows, "seconds": time.monotonic() - start}
+
+
+def log_summary(results):
+    """ log a table of the status, row count and run time of each dataset """
+    logger.info(f"{'dataset':<14}{'status':<10}{'rows':>10}{'seconds':>10}")
+    for dataset, result in results.items():
+        logger.info(
+            f"{dataset:<14}{result['status']:<10}{result['rows']:>10}{result['seconds']:>10.1f}"
+        )
 
 
 def main(args):
@@ -245,42 +674,47 @@ def main(args):
         aws_access_key_id=AWS_ACCESS_ID,
         aws_secret_access_key=AWS_PASS,
     )
-    socrata_client = get_socrata_client()
 
-    # Get a list of the files in the S3 Bucket
-    file_list = aws_list_files(aws_s3_client)
-
-    # Argument logic for publishing data
-    if args.dataset == "task_orders" or args.dataset == "all":
-        # Check if the file is in S3
-        if "task_orders.json" in file_list:
-            get_task_orders(aws_s3_client, socrata_client)
-        else:
-            logger.info(
-                "No task_orders.json file found in S3 Bucket, nothing happened."
+    datasets = list(SOCRATA_DATASETS) if args.dataset == "all" else [args.dataset]
+
+    # Check which of the datasets' files are in the S3 Bucket. The manifests hold the
+    # files' checksums.
+    keys = set()
+    for dataset in datasets:
+        keys.add(dataset_file(dataset))
+        keys.add(f"{SOCRATA_DATASETS[dataset]['record_type']}.manifest.json")
+    objects = s3_cache.head_objects(aws_s3_client, BUCKET_NAME, keys)
+    job_metrics = metrics.Metrics("s3_to_socrata")
+
+    # Publish the datasets concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {
+            dataset: executor.submit(
+                publish_dataset,
+                dataset,
+                aws_s3_client,
+                objects,
+                job_metrics,
+                force=args.force,
+                marker_dir=args.marker_dir,
+                marker_max_age_days=args.marker_max_age_days,
+                chunk_size=args.chunk_size,
+                checkpoint_dir=args.checkpoint_dir,
+                diff=args.diff,
+                delete=args.delete,
+                max_delete_fraction=args.max_delete_fraction,
+                row_hash_dir=args.row_hash_dir,
             )
-    if args.dataset == "dept_units" or args.dataset == "all":
-        # Check if the file is in S3
-        if "units.json" in file_list:
-            get_dept_unit(aws_s3_client, socrata_client)
-        else:
-            logger.info("No units.json file found in S3 Bucket, nothing happened.")
+            for dataset in datasets
+        }
+    results = {dataset: future.result() for dataset, future in futures.items()}
 
-    if args.dataset == "fdus" or args.dataset == "all":
-        # Check if the file is in S3
-        if "fdus.json" in file_list:
-            upsert_fdus(aws_s3_client, socrata_client)
-        else:
-            logger.info("No fdus.json file found in S3 Bucket, nothing happened.")
+    log_summary(results)
+    job_metrics.write_textfile()
 
-    if args.dataset == "subprojects" or args.dataset == "all":
-        # Check if the file is in S3
-        if "subprojects.json" in file_list:
-            get_subprojects(aws_s3_client, socrata_client)
-        else:
-            logger.info(
-                "No subprojects.json file found in S3 Bucket, nothing happened."
-            )
+    failed = [dataset for dataset in datasets if results[dataset]["status"] == "failed"]
+    if failed:
+        raise IOError(f"Failed to publish: {', '.join(failed)}")
     return
 
 
@@ -290,7 +724,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dataset",
         type=str,
-        choices=["task_orders", "dept_units", "fdus", "subprojects", "all"],
+        choices=list(SOCRATA_DATASETS) + ["all"],
         help=f"Which dataset to publish, defaults to all",
         default="all",
     )
@@ -302,7 +736,73 @@ if __name__ == "__main__":
         help=f"Sets logger to DEBUG level",
     )
 
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help=f"The maximum number of datasets to publish at once, defaults to 4",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help=f"The number of rows to send per upsert request, defaults to {CHUNK_SIZE}",
+    )
+
+    parser.add_argument(
+        "--checkpoint-dir",
+        type=str,
+        help=f"Save upsert progress to this directory so that a rerun can resume",
+    )
+
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help=f"Only send the rows which have changed since the last run, according to a store of row hashes",
+    )
+
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help=f"With --diff, delete the rows which are no longer in the source data",
+    )
+
+    parser.add_argument(
+        "--max-delete-fraction",
+        type=float,
+        default=DELETE_MAX_FRACTION,
+        help=f"Fail rather than delete more than this fraction of a dataset's rows, defaults to {DELETE_MAX_FRACTION}",
+    )
+
+    parser.add_argument(
+        "--row-hash-dir",
+        type=str,
+        help=f"Keep the row hash stores in this local directory rather than in S3",
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=f"Publish the datasets even if they have not changed since they were last published",
+    )
+
+    parser.add_argument(
+        "--marker-dir",
+        type=str,
+        help=f"Keep the last-processed markers in this local directory rather than in S3",
+    )
+
+    parser.add_argument(
+        "--marker-max-age-days",
+        type=int,
+        default=MARKER_MAX_AGE_DAYS,
+        help=f"Publish a dataset which has not changed if it was last published this many days ago, defaults to {MARKER_MAX_AGE_DAYS}",
+    )
+
     args = parser.parse_args()
+    if args.delete and not args.diff:
+        parser.error("--delete requires --diff")
 
     logger = utils.get_logger(
         __name__,
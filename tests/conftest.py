@@ -0,0 +1,128 @@
+import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the scripts are modules at the top level of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeKnackHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        with server.lock:
+            server.requests.append((method, url.path))
+            scripted = server.scripted.get((method, url.path))
+            action = scripted.pop(0) if scripted else None
+        if action == "drop":
+            # the request was received, but the connection is closed without a
+            # response, as when it is lost or times out
+            self.close_connection = True
+            return
+        if action is not None:
+            status, headers = action if isinstance(action, tuple) else (action, {})
+            return self.send_json(status, {"errors": [f"{status}"]}, headers)
+
+        # /objects/<obj>/records[/<id>]
+        parts = url.path.strip("/").split("/")
+        records = server.records.setdefault(parts[1], [])
+        if method == "GET":
+            query = urllib.parse.parse_qs(url.query)
+            page = int(query["page"][0])
+            rows_per_page = int(query["rows_per_page"][0])
+            time.sleep(server.page_delay(page))
+            data = {
+                "current_page": page,
+                "total_records": len(records),
+                "records": records[(page - 1) * rows_per_page : page * rows_per_page],
+            }
+            if server.send_total_pages:
+                data["total_pages"] = math.ceil(len(records) / rows_per_page)
+            return self.send_json(200, data)
+        with server.lock:
+            if method == "POST":
+                record = {"id": f"rec{next(server.ids)}", **body}
+                records.append(record)
+                return self.send_json(200, record)
+            index = next(i for i, rec in enumerate(records) if rec["id"] == parts[3])
+            if method == "PUT":
+                records[index].update(body)
+                return self.send_json(200, records[index])
+            del records[index]
+            return self.send_json(200, {"delete": True})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class FakeKnack(ThreadingHTTPServer):
+    """A local fake of the Knack records API.
+
+    Attributes:
+        records (dict): The records of each object
+        scripted (dict): Responses to give, in order, to a method and path before
+            it is handled normally: a status code, a (status code, headers) tuple, or
+            "drop" to close the connection without a response
+        requests (list): The (method, path) of every request received
+        page_delay (function): The seconds to wait before returning a page
+        send_total_pages (bool): If pages include `total_pages`
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeKnackHandler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.records = {}
+        self.scripted = {}
+        self.requests = []
+        self.page_delay = lambda page: 0
+        self.send_total_pages = True
+        self.ids = iter(range(1000000))
+        self.lock = threading.Lock()
+
+    def count(self, method):
+        return sum(1 for req_method, _ in self.requests if req_method == method)
+
+
+@pytest.fixture
+def knack_server():
+    server = FakeKnack()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
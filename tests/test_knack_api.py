@@ -0,0 +1,235 @@
+import importlib
+import time
+import types
+
+import pytest
+import requests
+
+import knack_api
+
+OBJ = "object_1"
+AUTH = {"app_id": "app", "api_key": "key"}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """ record the retry delays of knack_api.send rather than waiting for them """
+    delays = []
+    monkeypatch.setattr(
+        knack_api,
+        "time",
+        types.SimpleNamespace(monotonic=time.monotonic, sleep=delays.append),
+    )
+    return delays
+
+
+def send(knack_server, method, path, **kwargs):
+    session = knack_api.get_session("app", "key")
+    return knack_api.send(
+        session, knack_api.TokenBucket(1000), method, knack_server.url + path, **kwargs
+    )
+
+
+def test_token_bucket_limits_rate():
+    bucket = knack_api.TokenBucket(20, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.take()
+    # the first token is in the bucket, the other 10 arrive at 20 per second
+    assert time.monotonic() - start >= 0.45
+
+
+def test_send_retries_with_backoff(knack_server, sleeps):
+    path = f"/objects/{OBJ}/records"
+    knack_server.scripted[("GET", path)] = [503, 500]
+    res = send(knack_server, "GET", f"{path}?page=1&rows_per_page=10", backoff=1)
+    assert res.status_code == 200
+    assert sleeps == [1, 2]
+
+
+def test_send_honors_retry_after(knack_server, sleeps):
+    path = f"/objects/{OBJ}/records"
+    knack_server.scripted[("GET", path)] = [(429, {"Retry-After": "5"})]
+    send(knack_server, "GET", f"{path}?page=1&rows_per_page=10", backoff=1)
+    assert sleeps == [5]
+
+
+def test_send_gives_up_after_max_attempts(knack_server, sleeps):
+    path = f"/objects/{OBJ}/records"
+    knack_server.scripted[("GET", path)] = [500] * 3
+    with pytest.raises(requests.HTTPError):
+        send(knack_server, "GET", f"{path}?page=1&rows_per_page=10", max_attempts=3)
+    assert knack_server.count("GET") == 3
+
+
+def test_send_does_not_retry_client_errors(knack_server, sleeps):
+    path = f"/objects/{OBJ}/records/rec1"
+    knack_server.scripted[("PUT", path)] = [400]
+    with pytest.raises(requests.HTTPError):
+        send(knack_server, "PUT", path, json={})
+    assert knack_server.count("PUT") == 1
+
+
+def test_send_retries_creates_on_connect_errors(sleeps):
+    # nothing listens on port 1, so the request fails before it is sent
+    session = knack_api.get_session("app", "key")
+    with pytest.raises(requests.ConnectionError) as e:
+        knack_api.send(
+            session,
+            knack_api.TokenBucket(1000),
+            "POST",
+            "http://127.0.0.1:1/objects/object_1/records",
+            json={},
+            max_attempts=3,
+            idempotent=False,
+        )
+    assert knack_api.is_connect_error(e.value)
+    assert len(sleeps) == 2
+
+
+@pytest.mark.parametrize("action", [500, 502, 504, "drop"])
+def test_write_records_does_not_retry_creates(knack_server, sleeps, action):
+    knack_server.scripted[("POST", f"/objects/{OBJ}/records")] = [action]
+    done, failed = knack_api.write_records(
+        [{"field_1": "a"}], OBJ, url=knack_server.url, **AUTH
+    )
+    assert done == []
+    assert [record for record, _ in failed] == [{"field_1": "a"}]
+    assert knack_server.count("POST") == 1
+    assert knack_server.records.get(OBJ, []) == []
+
+
+def test_write_records_retries_creates_when_not_applied(knack_server, sleeps):
+    knack_server.scripted[("POST", f"/objects/{OBJ}/records")] = [429, 503]
+    done, failed = knack_api.write_records(
+        [{"field_1": "a"}], OBJ, url=knack_server.url, **AUTH
+    )
+    assert failed == []
+    assert [data for _, data in done] == [{"id": "rec0", "field_1": "a"}]
+    assert knack_server.count("POST") == 3
+    assert knack_server.records[OBJ] == [{"id": "rec0", "field_1": "a"}]
+
+
+@pytest.mark.parametrize("action", [500, 502, 503, 504, "drop"])
+def test_write_records_retries_updates(knack_server, sleeps, action):
+    knack_server.records[OBJ] = [{"id": "rec1", "field_1": "a"}]
+    knack_server.scripted[("PUT", f"/objects/{OBJ}/records/rec1")] = [action]
+    done, failed = knack_api.write_records(
+        [{"id": "rec1", "field_1": "b"}], OBJ, url=knack_server.url, **AUTH
+    )
+    assert failed == []
+    assert knack_server.count("PUT") == 2
+    assert knack_server.records[OBJ] == [{"id": "rec1", "field_1": "b"}]
+
+
+def test_process_records_collects_failures(knack_server, sleeps):
+    knack_server.records[OBJ] = [{"id": f"rec{i}", "field_1": "a"} for i in range(5)]
+    knack_server.scripted[("PUT", f"/objects/{OBJ}/records/rec2")] = [400]
+    knack_server.scripted[("DELETE", f"/objects/{OBJ}/records/rec4")] = [404]
+    updates = [{"id": f"rec{i}", "field_1": "b"} for i in range(4)]
+    done, failed = knack_api.write_records(
+        updates, OBJ, url=knack_server.url, workers=4, **AUTH
+    )
+    assert sorted(record["id"] for record, _ in done) == ["rec0", "rec1", "rec3"]
+    assert [record["id"] for record, _ in failed] == ["rec2"]
+    assert isinstance(failed[0][1], requests.HTTPError)
+
+    done, failed = knack_api.delete_records(
+        [{"id": "rec3"}, {"id": "rec4"}], OBJ, url=knack_server.url, **AUTH
+    )
+    assert [record["id"] for record, _ in done] == ["rec3"]
+    assert [record["id"] for record, _ in failed] == ["rec4"]
+    assert [rec["id"] for rec in knack_server.records[OBJ]] == [
+        "rec0",
+        "rec1",
+        "rec2",
+        "rec4",
+    ]
+
+
+def knack_records(count):
+    return [
+        {
+            "id": f"rec{i}",
+            "field_1": f"<span>{i}</span>",
+            "field_1_raw": i,
+            "field_2": "text",
+            "field_3": "",
+        }
+        for i in range(count)
+    ]
+
+
+def test_read_records_concurrent_pages_in_order(knack_server):
+    knack_server.records[OBJ] = knack_records(23)
+    # the later pages are returned first
+    knack_server.page_delay = lambda page: 0.05 * (6 - page)
+    records = knack_api.read_records(
+        OBJ, ["field_1"], url=knack_server.url, rows_per_page=5, workers=4, **AUTH
+    )
+    assert records == [{"id": f"rec{i}", "field_1": i} for i in range(23)]
+    assert knack_server.count("GET") == 5
+
+
+@pytest.mark.parametrize("send_total_pages", [True, False])
+def test_read_records_single_page(knack_server, send_total_pages):
+    knack_server.records[OBJ] = knack_records(3)
+    knack_server.send_total_pages = send_total_pages
+    records = knack_api.read_records(
+        OBJ, ["field_2"], url=knack_server.url, rows_per_page=5, **AUTH
+    )
+    assert records == [{"id": f"rec{i}", "field_2": "text"} for i in range(3)]
+    assert knack_server.count("GET") == 1
+
+
+def test_read_records_empty_object(knack_server):
+    # knack reports 0 pages for an empty object
+    records = knack_api.read_records(OBJ, ["field_1"], url=knack_server.url, **AUTH)
+    assert records == []
+    assert knack_server.count("GET") == 1
+
+
+def test_project_record_matches_knackpy():
+    knackpy = pytest.importorskip("knackpy")
+    # knackpy.record is shadowed by a function of the same name
+    Record = importlib.import_module("knackpy.record").Record
+    pytz = pytest.importorskip("pytz")
+    keys = ["field_1", "field_2", "field_3", "field_4", "field_5", "field_6"]
+    field_defs = [
+        knackpy.fields.FieldDef(key="id", name="id", type="id", obj=OBJ)
+    ] + [
+        knackpy.fields.FieldDef(key=key, name=key, type="short_text", obj=OBJ)
+        for key in keys
+    ]
+    records = [
+        {
+            "id": "rec1",
+            # raw values are used where they exist
+            "field_1": "<span>1,234.00</span>",
+            "field_1_raw": "1,234.00",
+            "field_2": "text",
+            # empty strings and lists are None, raw or not
+            "field_3": "",
+            "field_4": "",
+            "field_4_raw": [],
+            "field_5": "<span>a</span>",
+            "field_5_raw": [{"id": "rec2", "identifier": "a"}],
+            "field_6": [],
+        },
+        {
+            "id": "rec3",
+            "field_1": "0.00",
+            "field_1_raw": "0.00",
+            "field_2": "",
+            "field_3": "x",
+            "field_4": "",
+            "field_4_raw": "",
+            "field_5": "",
+            "field_5_raw": [],
+            "field_6": "y",
+        },
+    ]
+    timezone = pytz.timezone("US/Central")
+    for record in records:
+        expected = dict(Record(dict(record), field_defs, None, timezone))
+        assert knack_api.project_record(record, keys) == expected
@@ -0,0 +1,34 @@
+import arrow
+
+import markers
+
+
+def test_config_hash_changes_with_function_body():
+    first = lambda row: row["A"] + 1
+    second = lambda row: row["A"] + 2
+    # the same name, as a renamed or edited handler would have
+    first.__name__ = second.__name__ = "handler"
+    assert markers.config_hash({"handler": first}) != markers.config_hash(
+        {"handler": second}
+    )
+    assert markers.config_hash({"handler": first}) == markers.config_hash(
+        {"handler": first}
+    )
+
+
+def test_is_current():
+    config = {"columns": {"A": "B"}}
+    marker = markers.build("abc", config)
+    assert markers.is_current(marker, "abc", config)
+    assert not markers.is_current(marker, "abd", config)
+    assert not markers.is_current(marker, "abc", {"columns": {"A": "C"}})
+    assert not markers.is_current(None, "abc", config)
+
+
+def test_is_current_max_age():
+    config = {}
+    marker = markers.build("abc", config)
+    assert markers.is_current(marker, "abc", config, max_age_days=7)
+    marker["processed"] = arrow.utcnow().shift(days=-8).isoformat()
+    assert not markers.is_current(marker, "abc", config, max_age_days=7)
+    assert markers.is_current(marker, "abc", config)
@@ -0,0 +1,21 @@
+import pytest
+
+import row_hashes
+
+
+def test_diff():
+    data = [{"ID": i, "V": "a"} for i in range(5)]
+    store = row_hashes.build(data, "abcd-1234", "ID")
+    data[1]["V"] = "b"
+    data = data[:-1] + [{"ID": 5, "V": "a"}]
+    upserts, removed = row_hashes.diff(data, store, "ID")
+    assert upserts == [{"ID": 1, "V": "b"}, {"ID": 5, "V": "a"}]
+    assert removed == [4]
+
+
+def test_duplicate_ids():
+    data = [{"ID": 1}, {"ID": 2}, {"ID": 1}, {"ID": 3}, {"ID": 2}, {"ID": 1}]
+    assert row_hashes.duplicate_ids(data, "ID") == [1, 2]
+    assert row_hashes.duplicate_ids(data[:2], "ID") == []
+    with pytest.raises(ValueError):
+        row_hashes.hash_rows(data, "ID")
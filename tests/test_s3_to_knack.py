@@ -0,0 +1,134 @@
+import argparse
+
+import pytest
+
+import s3_to_knack
+from config import add_comma_separator, stringify_value
+
+APP_NAME = "data-tracker"
+KNACK_PK = "field_1"
+FIELD_MAP = [
+    {"src": "ID", APP_NAME: "field_1", "primary_key": True},
+    {"src": "STATUS", APP_NAME: "field_2", "handler": stringify_value},
+    {"src": "AMOUNT", APP_NAME: "field_3", "handler": add_comma_separator},
+    {"src": "NAME", APP_NAME: "field_4"},
+]
+DEACTIVATE = {"action": "deactivate", "values": {"STATUS": 0, "AMOUNT": 0}}
+DELETE = {"action": "delete"}
+
+
+def make_diff(records_current, records_knack):
+    return s3_to_knack.diff_records(
+        records_current, records_knack, KNACK_PK, FIELD_MAP, APP_NAME
+    )
+
+
+def knack_record(id_, status="1", amount="10.00"):
+    return {
+        "id": f"knack{id_}",
+        "field_1": id_,
+        "field_2": status,
+        "field_3": amount,
+        "field_4": f"name {id_}",
+    }
+
+
+def source_record(id_):
+    return {"ID": id_, "STATUS": 1, "AMOUNT": 10, "NAME": f"name {id_}"}
+
+
+def test_get_deactivate_values_applies_handlers():
+    values = s3_to_knack.get_deactivate_values(DEACTIVATE, FIELD_MAP, APP_NAME)
+    assert values == {"field_2": "0", "field_3": "0.00"}
+    # the same values as map_record gives for an inactive source record
+    mapped = s3_to_knack.create_mapped_record(
+        {"ID": 1, "STATUS": 0, "AMOUNT": 0, "NAME": "name 1"}, FIELD_MAP, APP_NAME
+    )
+    assert values.items() <= mapped.items()
+
+
+def test_get_deactivate_values_unknown_field():
+    with pytest.raises(ValueError):
+        s3_to_knack.get_deactivate_values(
+            {"action": "deactivate", "values": {"MISSING": 0}}, FIELD_MAP, APP_NAME
+        )
+
+
+def test_find_orphans_deactivate():
+    records_knack = [
+        knack_record(1),
+        knack_record(2),
+        # already deactivated
+        knack_record(3, status="0", amount="0.00"),
+    ]
+    diff = make_diff([source_record(1)], records_knack)
+    orphans, inactive = s3_to_knack.find_orphans(
+        diff, DEACTIVATE, FIELD_MAP, APP_NAME, KNACK_PK
+    )
+    assert [rec["id"] for rec in orphans] == ["knack2"]
+    assert inactive == {"3"}
+
+
+def test_find_orphans_fingerprints():
+    diff = make_diff([source_record(1)], [knack_record(1), knack_record(2), knack_record(3)])
+    records_fingerprint = {
+        "2": ["knack2", "abc"],
+        "3": ["knack3", s3_to_knack.fingerprints.DEACTIVATED],
+    }
+    orphans, inactive = s3_to_knack.find_orphans(
+        diff, DEACTIVATE, FIELD_MAP, APP_NAME, KNACK_PK, records_fingerprint
+    )
+    assert [rec["id"] for rec in orphans] == ["knack2"]
+    assert inactive == {"3"}
+
+
+def test_find_orphans_delete():
+    records_knack = [knack_record(1), knack_record(2), knack_record(3, status="0")]
+    diff = make_diff([source_record(1)], records_knack)
+    orphans, inactive = s3_to_knack.find_orphans(
+        diff, DELETE, FIELD_MAP, APP_NAME, KNACK_PK
+    )
+    assert [rec["id"] for rec in orphans] == ["knack2", "knack3"]
+    assert inactive == set()
+
+
+def test_check_orphan_threshold():
+    records_knack = [knack_record(i) for i in range(20)]
+    diff = make_diff([source_record(i) for i in range(19)], records_knack)
+    orphans = diff["orphaned"]
+    assert s3_to_knack.check_orphan_threshold(orphans, diff, 0.05) is None
+    assert s3_to_knack.check_orphan_threshold(orphans, diff, 0.04)
+    assert s3_to_knack.check_orphan_threshold([], diff, 0) is None
+
+
+@pytest.mark.parametrize(
+    "orphan_config, expected",
+    [
+        (
+            DEACTIVATE,
+            [
+                {"id": "knack2", "field_2": "0", "field_3": "0.00"},
+                {"id": "knack3", "field_2": "0", "field_3": "0.00"},
+            ],
+        ),
+        (DELETE, [{"id": "knack2"}, {"id": "knack3"}]),
+    ],
+)
+def test_handle_orphans(monkeypatch, orphan_config, expected):
+    payloads = []
+
+    def process(records, knack_obj, **kwargs):
+        payloads.extend(records)
+        # the second record fails
+        return [(records[0], {})], [(records[1], IOError("failed"))]
+
+    monkeypatch.setattr(s3_to_knack.knack_api, "write_records", process)
+    monkeypatch.setattr(s3_to_knack.knack_api, "delete_records", process)
+    orphans = [knack_record(2), knack_record(3)]
+    args = argparse.Namespace(workers=1, rate=10)
+    handled, failed = s3_to_knack.handle_orphans(
+        orphans, orphan_config, "object_1", FIELD_MAP, APP_NAME, KNACK_PK, args
+    )
+    assert payloads == expected
+    assert handled == {"2"}
+    assert [record["id"] for record, _ in failed] == ["knack3"]
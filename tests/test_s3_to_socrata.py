@@ -0,0 +1,283 @@
+import copy
+import logging
+import time
+import types
+
+import pytest
+import requests
+
+import metrics
+import s3_to_socrata
+from benchmark import GENERATORS
+from config import SOCRATA_DATASETS
+
+
+# the original transforms, before they were made configurable and fused, as the
+# oracle for the current ones
+
+
+def baseline_transform_tks(data):
+    columns = {
+        "TASK_ORDER_DEPT": "DEPT",
+        "TASK_ORDER_ID": "TASK_ORDER",
+        "TASK_ORDER_DESC": "NAME",
+        "TASK_ORDER_STATUS": "Status",
+        "TASK_ORDER_TYPE": "TK_TYPE",
+        "TK_CURR_AMOUNT": "CURRENT_ESTIMATE",
+        "CHARGED_AMOUNT": "CHARGEDAMOUNT",
+        "TASK_ORDER_BAL": "BALANCE",
+        "BYR_FDU": "BUYER_FDUS",
+    }
+
+    replaced_data = []
+    for row in data:
+        new_row = {}
+        for src_key, dest_key in columns.items():
+            new_row[dest_key] = row.get(src_key)
+        new_row["DISPLAY_NAME"] = new_row["TASK_ORDER"] + " | " + new_row["NAME"]
+        replaced_data.append(new_row)
+
+    return replaced_data
+
+
+def baseline_remove_forbidden_keys(data, forbidden_keys):
+    new_data = []
+    for row in data:
+        new_row = {k: v for k, v in row.items() if k.upper() not in forbidden_keys}
+        new_data.append(new_row)
+    return new_data
+
+
+def baseline_remove_dupe_rows(data, primary_key):
+    ids = []
+    new_data = []
+    for row in data:
+        if row[primary_key] not in ids:
+            ids.append(row[primary_key])
+            new_data.append(row)
+    return new_data
+
+
+def baseline_subprojects(data):
+    data = baseline_remove_forbidden_keys(
+        data, forbidden_keys=["SUB_PROJECT_LAST_UPDATE_BY", "SUB_PROJECT_MANAGER"]
+    )
+    return baseline_remove_dupe_rows(data, primary_key="SP_NUMBER_TXT")
+
+
+# how each dataset was transformed before it was in config.SOCRATA_DATASETS
+BASELINES = {
+    "task_orders": baseline_transform_tks,
+    "dept_units": lambda data: data,
+    "fdus": lambda data: data,
+    "subprojects": baseline_subprojects,
+}
+
+
+@pytest.mark.parametrize("dataset", SOCRATA_DATASETS)
+def test_transform_matches_baseline(dataset):
+    dataset_config = SOCRATA_DATASETS[dataset]
+    data = GENERATORS[dataset_config["record_type"]](2000)
+    original = copy.deepcopy(data)
+    new_data, _ = s3_to_socrata.transform(data, dataset_config)
+    assert new_data == BASELINES[dataset](data)
+    # the source rows are left unchanged
+    assert data == original
+
+
+def test_transform_tks_matches_baseline():
+    data = GENERATORS["task_orders"](2000)
+    assert s3_to_socrata.transform_tks(data) == baseline_transform_tks(data)
+
+
+def test_remove_forbidden_keys_matches_baseline():
+    data = GENERATORS["subprojects"](2000)
+    forbidden_keys = ["SUB_PROJECT_MANAGER", "SP_STATUS"]
+    assert s3_to_socrata.remove_forbidden_keys(
+        data, forbidden_keys
+    ) == baseline_remove_forbidden_keys(data, forbidden_keys)
+
+
+def test_remove_dupe_rows_matches_baseline():
+    data = GENERATORS["subprojects"](2000)
+    assert s3_to_socrata.remove_dupe_rows(
+        data, "SP_NUMBER_TXT"
+    ) == baseline_remove_dupe_rows(data, "SP_NUMBER_TXT")
+
+
+def test_transform_keep_last_keeps_first_position():
+    dataset_config = {"dedupe_key": "ID", "dedupe_policy": "keep-last"}
+    data = [{"ID": 1, "V": "a"}, {"ID": 2, "V": "b"}, {"ID": 1, "V": "c"}]
+    assert s3_to_socrata.transform(data, dataset_config) == (
+        [{"ID": 1, "V": "c"}, {"ID": 2, "V": "b"}],
+        {1: 1},
+    )
+
+
+def test_transform_error_policy():
+    dataset_config = {"dedupe_key": "ID", "dedupe_policy": "error"}
+    identical = [{"ID": 1, "V": "a"}, {"ID": 1, "V": "a"}]
+    assert s3_to_socrata.transform(identical, dataset_config) == (
+        [{"ID": 1, "V": "a"}],
+        {1: 1},
+    )
+    conflicting = [{"ID": 1, "V": "a"}, {"ID": 1, "V": "b"}]
+    with pytest.raises(ValueError):
+        s3_to_socrata.transform(conflicting, dataset_config)
+    with pytest.raises(ValueError):
+        s3_to_socrata.dedupe_rows(conflicting, "ID", policy="error")
+
+
+def test_transform_unknown_policy():
+    with pytest.raises(ValueError):
+        s3_to_socrata.transform([], {"dedupe_key": "ID", "dedupe_policy": "keep-any"})
+
+
+class FakeSocrata:
+    """ records the upserted rows, and rejects the rows with a `reject` column """
+
+    def __init__(self, row_id="ID"):
+        self.row_id = row_id
+        self.upserts = []
+
+    def get_metadata(self, dataset_id):
+        return {
+            "rowIdentifierColumnId": 2,
+            "columns": [
+                {"id": 1, "fieldName": "name"},
+                {"id": 2, "fieldName": self.row_id.lower()},
+            ],
+        }
+
+    def upsert(self, dataset_id, rows):
+        self.upserts.extend(rows)
+        errors = sum(1 for row in rows if row.get("reject"))
+        return {"Rows Updated": len(rows) - errors, "Errors": errors}
+
+
+@pytest.fixture(autouse=True)
+def logger(monkeypatch):
+    # the logger is set up by main
+    monkeypatch.setattr(
+        s3_to_socrata, "logger", logging.getLogger("s3_to_socrata"), raising=False
+    )
+
+
+def write_rows(socrata_client, data, tmp_path, **options):
+    return s3_to_socrata.write_rows(
+        None,
+        socrata_client,
+        "test",
+        "abcd-1234",
+        "ID",
+        data,
+        metrics.Metrics("test"),
+        diff=True,
+        row_hash_dir=str(tmp_path),
+        **options,
+    )
+
+
+def test_check_row_id():
+    s3_to_socrata.check_row_id(FakeSocrata("ID"), "abcd-1234", "ID")
+    with pytest.raises(ValueError):
+        s3_to_socrata.check_row_id(FakeSocrata("NAME"), "abcd-1234", "ID")
+    with pytest.raises(ValueError):
+        s3_to_socrata.check_row_id(FakeSocrata("ID"), "abcd-1234", "OTHER_ID")
+
+
+def test_write_rows_diff(tmp_path):
+    data = [{"ID": i, "V": "a"} for i in range(10)]
+    assert write_rows(FakeSocrata(), data, tmp_path) == 10
+    data[3]["V"] = "b"
+    socrata_client = FakeSocrata()
+    assert (
+        write_rows(
+            socrata_client, data[:-1], tmp_path, delete=True, max_delete_fraction=0.5
+        )
+        == 2
+    )
+    assert socrata_client.upserts == [{"ID": 3, "V": "b"}, {"ID": 9, ":deleted": True}]
+
+
+def test_write_rows_rejected_rows_are_resent(tmp_path):
+    data = [{"ID": i, "V": "a"} for i in range(10)]
+    write_rows(FakeSocrata(), data, tmp_path)
+    data[3]["V"] = "b"
+    data[4]["V"] = "b"
+    data[4]["reject"] = True
+    with pytest.raises(IOError):
+        write_rows(FakeSocrata(), data, tmp_path)
+    # the store was not saved, so the rejected row is sent again
+    del data[4]["reject"]
+    socrata_client = FakeSocrata()
+    write_rows(socrata_client, data, tmp_path)
+    assert [row["ID"] for row in socrata_client.upserts] == [3, 4]
+
+
+def test_write_rows_duplicate_row_ids(tmp_path):
+    data = [{"ID": 1, "V": "a"}, {"ID": 2, "V": "b"}, {"ID": 1, "V": "c"}]
+    socrata_client = FakeSocrata()
+    with pytest.raises(ValueError):
+        write_rows(socrata_client, data, tmp_path)
+    assert socrata_client.upserts == []
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+class FlakySocrata:
+    """ raises the given errors from its first upserts """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.attempts = 0
+
+    def upsert(self, dataset_id, rows):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"Rows Created": len(rows)}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(
+        s3_to_socrata,
+        "time",
+        types.SimpleNamespace(monotonic=time.monotonic, sleep=delays.append),
+    )
+    return delays
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        http_error(429),
+        http_error(500),
+        http_error(503),
+        requests.ReadTimeout(),
+        requests.ConnectionError(),
+    ],
+)
+def test_upsert_chunked_retries_transient_errors(sleeps, error):
+    socrata_client = FlakySocrata([error])
+    res = s3_to_socrata.upsert_chunked(
+        socrata_client, "abcd-1234", [{"ID": 1}], backoff=2
+    )
+    assert res == {"Rows Created": 1}
+    assert socrata_client.attempts == 2
+    assert sleeps == [2]
+
+
+@pytest.mark.parametrize("status_code", [400, 401, 403, 404])
+def test_upsert_chunked_raises_client_errors(sleeps, status_code):
+    socrata_client = FlakySocrata([http_error(status_code)])
+    with pytest.raises(requests.HTTPError):
+        s3_to_socrata.upsert_chunked(socrata_client, "abcd-1234", [{"ID": 1}])
+    assert socrata_client.attempts == 1
+    assert sleeps == []
@@ -0,0 +1,69 @@
+import pytest
+
+import upload_to_s3
+from queries import INCREMENTAL
+
+CONFIG = {"primary_key": "ID", "hash_columns": ["ID", "NAME"]}
+
+
+class FakeCursor:
+    """ returns the given columns and rows for any query """
+
+    def __init__(self, columns, rows):
+        self.description = [(col, None) for col in columns]
+        self.rows = rows
+        self.rowfactory = None
+
+    def execute(self, query, params):
+        self.query = query
+
+    def fetchall(self):
+        return [self.rowfactory(*row) for row in self.rows]
+
+
+class FakeConnection:
+    def __init__(self, columns, rows=()):
+        self.columns = columns
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self.columns, self.rows)
+
+
+def test_check_hash_columns():
+    upload_to_s3.check_hash_columns(["ID", "NAME"], CONFIG)
+    with pytest.raises(ValueError, match="Not hashed: \\['AMOUNT'\\]"):
+        upload_to_s3.check_hash_columns(["ID", "NAME", "AMOUNT"], CONFIG)
+    with pytest.raises(ValueError, match="not in the query: \\['NAME'\\]"):
+        upload_to_s3.check_hash_columns(["ID"], CONFIG)
+
+
+def test_extract_full():
+    conn = FakeConnection(["ID", "NAME", "ROW_HASH"], [(1, "a", "h1"), (2, "b", "h2")])
+    rows, state = upload_to_s3.extract_full(conn, "SELECT ID, NAME FROM T", CONFIG)
+    assert rows == [{"ID": 1, "NAME": "a"}, {"ID": 2, "NAME": "b"}]
+    assert state["primary_key"] == "ID"
+    assert set(state["hashes"]) == {"1", "2"}
+
+
+def test_extract_full_unhashed_column():
+    conn = FakeConnection(["ID", "NAME", "AMOUNT", "ROW_HASH"], [(1, "a", 5, "h1")])
+    with pytest.raises(ValueError):
+        upload_to_s3.extract_full(conn, "SELECT ID, NAME, AMOUNT FROM T", CONFIG)
+
+
+def test_extract_incremental_unhashed_column():
+    conn = FakeConnection(["ID", "NAME", "AMOUNT"])
+    with pytest.raises(ValueError):
+        upload_to_s3.extract_incremental(
+            conn, "SELECT ID, NAME, AMOUNT FROM T", CONFIG, [], {"hashes": {}}
+        )
+
+
+@pytest.mark.parametrize("name", INCREMENTAL)
+def test_incremental_hash_columns_match_query(name):
+    # the columns of a query are the last part of each line of its SELECT list
+    query = upload_to_s3.QUERIES[name]
+    select_list = query.split("SELECT", 1)[1].split("FROM", 1)[0]
+    columns = [col.strip().split(".")[-1] for col in select_list.split(",")]
+    upload_to_s3.check_hash_columns(columns, INCREMENTAL[name])
@@ -3,19 +3,37 @@
 """
 Fetch financial records from the controller's office DB and **replace** data in AWS S3.
 
-For each record type (e.g., task orders), a single JSON file is uploaded/replaced in S3.
+For each record type (e.g., task orders), a single JSON file is uploaded/replaced in S3,
+along with a compressed NDJSON copy of the file and a manifest which describes it.
+
+Record types listed in `queries.INCREMENTAL` may instead be extracted incrementally,
+in which case only the records which have changed since the last run are fetched from
+the DB and merged into the existing JSON file.
+
+Several record types (or `all` of them) may be processed in one run, in which case
+their queries run concurrently on a pool of DB sessions. The queries of record types
+listed in `queries.PARTITIONS` may also be split into partitions which run
+concurrently.
+
+A snapshot whose content has not changed since the last upload is not replaced (see
+`upload_snapshot`), unless the `--force` option is given.
 """
 import argparse
+import concurrent.futures
+import hashlib
 import io
 import json
 import logging
 import os
 import sys
+import time
+import zlib
 
 import boto3
-import cx_Oracle
 
-from queries import QUERIES
+import metrics
+import s3_cache
+from queries import INCREMENTAL, PARTITIONS, QUERIES
 
 USER = os.getenv("USER")
 PASSWORD = os.getenv("PASSWORD")
@@ -27,13 +45,528 @@ BUCKET = os.getenv("BUCKET")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 
+# the number of rows fetched from the DB per round trip when streaming
+ARRAYSIZE = 5000
+# S3 requires every part of a multipart upload except the last to be at least 5MB
+PART_SIZE = 8 * 1024 * 1024
+# oracle allows at most 1000 expressions in an IN list
+MAX_IN_LIST = 1000
+# the number of queries run at once when processing several record types
+PARALLEL = 3
+
+JSON_TYPES = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    type(None): "null",
+}
+
 
 def fileobj(list_of_dicts):
     """ convert a list of dictionaries to a json file-like object """
     return io.BytesIO(json.dumps(list_of_dicts).encode())
 
 
+class MultipartUpload:
+    """Upload an S3 object in parts as it is written, so that no more than one part
+    is held in memory at a time.
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        bucket (str): The destination bucket name
+        key (str): The destination object key
+        part_size (int, optional): The size in bytes of each uploaded part.
+            Defaults to PART_SIZE.
+    """
+
+    def __init__(self, client, bucket, key, part_size=PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.size = 0
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.size += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        res = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=self.buffer.getvalue(),
+        )
+        self.parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+        self.buffer = io.BytesIO()
+
+    def complete(self):
+        # the last part may be smaller than the minimum part size
+        if self.buffer.tell() or not self.parts:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def fetch_batches(cursor, arraysize=ARRAYSIZE, job_metrics=None):
+    """Yield lists of row dicts from an executed cursor, `arraysize` rows at a time.
+    The time spent fetching is recorded as the "fetch" stage of `job_metrics`, if
+    given, once the cursor is exhausted."""
+    columns = [d[0] for d in cursor.description]
+    seconds = 0
+    count = 0
+    while True:
+        start = time.monotonic()
+        rows = cursor.fetchmany(arraysize)
+        batch = [dict(zip(columns, row)) for row in rows]
+        seconds += time.monotonic() - start
+        if not batch:
+            break
+        count += len(batch)
+        yield batch
+    if job_metrics:
+        job_metrics.record("fetch", seconds, rows=count)
+
+
+def json_type(value):
+    """ the JSON type name of a deserialized value, for the snapshot manifest """
+    return JSON_TYPES.get(type(value), type(value).__name__)
+
+
+def canonical_rows_digest(row_lines):
+    """Return the sum of the SHA-256 hashes of each row's canonical JSON (with sorted
+    keys). Adding up the row hashes makes a snapshot's checksum independent of the
+    order of its rows, which Oracle does not guarantee without an ORDER BY, and which
+    differs between full, partitioned and incremental extracts."""
+    return sum(
+        int.from_bytes(hashlib.sha256(line.encode()).digest(), "big")
+        for line in row_lines
+    )
+
+
+def snapshot_checksum(rows_digest):
+    """ format the sum of a snapshot's row hashes as its checksum """
+    return f"{rows_digest % 2 ** 256:064x}"
+
+
+def upload_snapshot(
+    client,
+    bucket,
+    name,
+    batches,
+    part_size=PART_SIZE,
+    job_metrics=None,
+    previous_checksum=None,
+):
+    """Encode batches of rows and upload them to S3 as they arrive, in two formats:
+
+    - `{name}.json`: a single JSON array, identical to `fileobj(rows)`
+    - `{name}.ndjson.gz`: gzip-compressed, newline-delimited JSON, one row per line
+
+    Once both files are uploaded, a `{name}.manifest.json` file is uploaded which
+    describes the compressed file: its column types, row count, and the SHA-256 hash
+    of its uncompressed content. Readers should only use the compressed file when it
+    matches the manifest. The manifest also holds the snapshot's `checksum`, which
+    does not depend on the order of the rows (see `canonical_rows_digest`). It is
+    stored in the manifest's `checksum` metadata too, so that it can be read with a
+    HEAD request.
+
+    If the checksum matches `previous_checksum`, the existing files are left as they
+    are. When the rows arrive in a single batch nothing is uploaded at all, otherwise
+    the parts which were uploaded are discarded.
+
+    Args:
+        client (botocore.client.S3): An S3 client
+        bucket (str): The destination bucket name
+        name (str): The record type name
+        batches (iterable): Lists of row dicts, e.g. from `fetch_batches`
+        part_size (int, optional): The multipart upload part size in bytes.
+        job_metrics (metrics.Metrics, optional): Records the time spent encoding the
+            rows ("serialize") and uploading them ("upload")
+        previous_checksum (str, optional): The checksum of the existing snapshot
+
+    Returns:
+        tuple: The number of rows, and whether the snapshot was uploaded
+
+    Raises:
+        IOError: If there are no rows, in which case nothing is uploaded
+    """
+    batches = iter(batches)
+    batch = next(batches, None)
+    if not batch:
+        raise IOError(
+            "No data was retrieved from the financial database. This should never happen!"
+        )
+
+    # the uploads are started once the first batch is encoded, by which time we
+    # know whether it is the only batch, and so whether it has changed
+    json_upload = ndjson_upload = None
+    # wbits=31 produces the gzip format
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    content_hash = hashlib.sha256()
+    rows_digest = 0
+    columns = {}
+    count = 0
+    serialize_seconds = 0
+    upload_seconds = 0
+    try:
+        while batch is not None:
+            next_batch = next(batches, None)
+            start = time.monotonic()
+            # strip the enclosing brackets so that batches join into one array
+            chunk = json.dumps(batch)[1:-1]
+            json_chunk = (", " + chunk if count else chunk).encode()
+
+            # the NDJSON lines are canonical JSON, so they are hashed for the checksum
+            # as they are
+            row_lines = [json.dumps(row, sort_keys=True) for row in batch]
+            rows_digest += canonical_rows_digest(row_lines)
+            lines = "".join(line + "\n" for line in row_lines).encode()
+            content_hash.update(lines)
+            ndjson_chunk = compressor.compress(lines)
+
+            for row in batch:
+                for key, val in row.items():
+                    columns.setdefault(key, set()).add(json_type(val))
+            count += len(batch)
+            uploading = time.monotonic()
+            serialize_seconds += uploading - start
+
+            if json_upload is None:
+                if next_batch is None and snapshot_checksum(rows_digest) == previous_checksum:
+                    break
+                json_upload = MultipartUpload(
+                    client, bucket, f"{name}.json", part_size=part_size
+                )
+                ndjson_upload = MultipartUpload(
+                    client, bucket, f"{name}.ndjson.gz", part_size=part_size
+                )
+                json_upload.write(b"[")
+            json_upload.write(json_chunk)
+            ndjson_upload.write(ndjson_chunk)
+            upload_seconds += time.monotonic() - uploading
+            batch = next_batch
+
+        uploading = time.monotonic()
+        unchanged = snapshot_checksum(rows_digest) == previous_checksum
+        if json_upload and unchanged:
+            json_upload.abort()
+            ndjson_upload.abort()
+        elif json_upload:
+            json_upload.write(b"]")
+            ndjson_upload.write(compressor.flush())
+            json_upload.complete()
+            ndjson_upload.complete()
+    except BaseException:
+        # the NDJSON upload is not started if starting the JSON upload fails, nor
+        # if starting the NDJSON upload itself fails
+        if json_upload:
+            json_upload.abort()
+        if ndjson_upload:
+            ndjson_upload.abort()
+        raise
+
+    if unchanged:
+        logging.info(f"{name} has not changed since it was last uploaded. Skipping upload.")
+        if job_metrics:
+            job_metrics.record("serialize", serialize_seconds, rows=count)
+        return count, False
+
+    manifest = {
+        "format": "ndjson.gz",
+        "file": f"{name}.ndjson.gz",
+        "rows": count,
+        "columns": {key: sorted(types) for key, types in columns.items()},
+        "sha256": content_hash.hexdigest(),
+        "checksum": snapshot_checksum(rows_digest),
+    }
+    client.put_object(
+        Bucket=bucket,
+        Key=f"{name}.manifest.json",
+        Body=json.dumps(manifest).encode(),
+        Metadata={"checksum": manifest["checksum"]},
+    )
+    upload_seconds += time.monotonic() - uploading
+    if job_metrics:
+        job_metrics.record("serialize", serialize_seconds, rows=count)
+        job_metrics.record(
+            "upload",
+            upload_seconds,
+            rows=count,
+            nbytes=json_upload.size + ndjson_upload.size,
+        )
+    return count, True
+
+
+def execute(conn, query, params=None):
+    """ execute a query and return its cursor, which fetches each row as a dict """
+    cursor = conn.cursor()
+    cursor.execute(query, params or [])
+    # define row handler which returns each row as a dict
+    # h/t https://stackoverflow.com/questions/35045879/cx-oracle-how-can-i-receive-each-row-as-a-dictionary
+    cursor.rowfactory = lambda *args: dict(
+        zip([d[0] for d in cursor.description], args)
+    )
+    return cursor
+
+
+def fetch_rows(conn, query, params=None):
+    """ execute a query and return each row as a dict """
+    return execute(conn, query, params).fetchall()
+
+
+def state_file_name(name):
+    """ the name of the S3 file which holds the incremental extraction state """
+    return f"{name}.state.json"
+
+
+def invalidate_state(client, name):
+    """Delete the incremental extraction state of a record type after a full
+    extract, because its hashes no longer describe the published records"""
+    if name in INCREMENTAL:
+        client.delete_object(Bucket=BUCKET, Key=state_file_name(name))
+
+
+def row_hash_expression(hash_columns):
+    """Return a SQL expression which hashes the given columns of a row. Requires
+    Oracle 12c or later."""
+    concatenated = " || '|' || ".join(hash_columns)
+    return f"RAWTOHEX(STANDARD_HASH({concatenated}, 'SHA256'))"
+
+
+def record_hashes(rows, primary_key):
+    """Combine the row hashes of each primary key into a single hash. A record may
+    span multiple rows (e.g. a task order with multiple buyer FDUs), so the combined
+    hash changes if any of its rows are added, removed, or modified.
+
+    Args:
+        rows (list): Row dicts with the primary key and a `ROW_HASH` value
+        primary_key (str): The primary key column name
+
+    Returns:
+        dict: The combined hash of each primary key
+    """
+    row_hashes = {}
+    for row in rows:
+        row_hashes.setdefault(str(row[primary_key]), []).append(row["ROW_HASH"])
+    return {
+        pk: hashlib.sha256("|".join(sorted(hashes)).encode()).hexdigest()
+        for pk, hashes in row_hashes.items()
+    }
+
+
+def check_hash_columns(columns, config):
+    """Check that the `hash_columns` of a record type's incremental config are the
+    columns its query selects. A column which is not hashed would never be updated
+    by an incremental run.
+
+    Raises:
+        ValueError: If the columns differ
+    """
+    unhashed = [col for col in columns if col not in config["hash_columns"]]
+    missing = [col for col in config["hash_columns"] if col not in columns]
+    if unhashed or missing:
+        raise ValueError(
+            f"The hash_columns do not match the query's columns. Not hashed: {unhashed}, not in the query: {missing}"
+        )
+
+
+def query_columns(conn, query):
+    """ return the names of the columns a query selects, without fetching any rows """
+    cursor = execute(conn, f"SELECT * FROM ({query}) WHERE 1 = 0")
+    return [d[0] for d in cursor.description]
+
+
+def extract_full(conn, query, config):
+    """Fetch all rows for a record type, along with the hashes that let the next
+    incremental run find changed records
+
+    Returns:
+        tuple: The rows, and the extraction state to save alongside them
+
+    Raises:
+        ValueError: If the `hash_columns` are not the query's columns
+    """
+    hash_expr = row_hash_expression(config["hash_columns"])
+    cursor = execute(conn, f"SELECT q.*, {hash_expr} AS ROW_HASH FROM ({query}) q")
+    check_hash_columns([d[0] for d in cursor.description if d[0] != "ROW_HASH"], config)
+    rows = cursor.fetchall()
+    hashes = record_hashes(rows, config["primary_key"])
+    for row in rows:
+        row.pop("ROW_HASH")
+    return rows, {"primary_key": config["primary_key"], "hashes": hashes}
+
+
+def extract_incremental(conn, query, config, rows_previous, state_previous):
+    """Fetch the records which have changed since the previous run and merge them
+    into the previously published rows
+
+    Args:
+        conn (cx_Oracle.Connection): The DB connection
+        query (str): The record type's query
+        config (dict): The record type's `queries.INCREMENTAL` entry
+        rows_previous (list): The rows published by the previous run
+        state_previous (dict): The extraction state saved by the previous run
+
+    Returns:
+        tuple: The merged rows, the new extraction state, and the number of
+            records which were changed or deleted
+
+    Raises:
+        ValueError: If the `hash_columns` are not the query's columns
+    """
+    check_hash_columns(query_columns(conn, query), config)
+    pk = config["primary_key"]
+    hash_expr = row_hash_expression(config["hash_columns"])
+    hash_rows = fetch_rows(
+        conn, f"SELECT q.{pk}, {hash_expr} AS ROW_HASH FROM ({query}) q"
+    )
+    hashes = record_hashes(hash_rows, pk)
+    hashes_previous = state_previous["hashes"]
+
+    changed = [key for key, val in hashes.items() if hashes_previous.get(key) != val]
+    deleted = [key for key in hashes_previous if key not in hashes]
+    logging.info(f"{len(changed)} changed and {len(deleted)} deleted records")
+
+    rows_changed = []
+    for i in range(0, len(changed), MAX_IN_LIST):
+        keys = changed[i : i + MAX_IN_LIST]
+        binds = ", ".join(f":{n + 1}" for n in range(len(keys)))
+        rows_changed += fetch_rows(
+            conn, f"SELECT * FROM ({query}) WHERE {pk} IN ({binds})", keys
+        )
+
+    stale = set(changed) | set(deleted)
+    rows = [row for row in rows_previous if str(row[pk]) not in stale] + rows_changed
+    return rows, {"primary_key": pk, "hashes": hashes}, len(stale)
+
+
+def partition_queries(query, config):
+    """Split a query into partitions, as declared in `queries.PARTITIONS`
+
+    Args:
+        query (str): The record type's query
+        config (dict): The record type's `queries.PARTITIONS` entry
+
+    Returns:
+        list: The (SQL, bind parameters) of each partition
+
+    Raises:
+        ValueError: If the partition scheme is not supported
+    """
+    column = config["column"]
+    if config["scheme"] == "hash":
+        n = config["partitions"]
+        # ORA_HASH is null for a null value, so nulls are added to the first partition
+        return [
+            (
+                f"SELECT * FROM ({query}) q WHERE ORA_HASH(q.{column}, {n - 1}) = :1"
+                + (f" OR q.{column} IS NULL" if partition == 0 else ""),
+                [partition],
+            )
+            for partition in range(n)
+        ]
+    if config["scheme"] == "list":
+        values_all = [value for values in config["values"] for value in values]
+        if len(values_all) > MAX_IN_LIST:
+            raise ValueError(f"At most {MAX_IN_LIST} partition values are supported")
+        partitions = []
+        for values in config["values"]:
+            binds = ", ".join(f":{n + 1}" for n in range(len(values)))
+            partitions.append(
+                (f"SELECT * FROM ({query}) q WHERE q.{column} IN ({binds})", values)
+            )
+        binds = ", ".join(f":{n + 1}" for n in range(len(values_all)))
+        partitions.append(
+            (
+                f"SELECT * FROM ({query}) q WHERE q.{column} NOT IN ({binds}) OR q.{column} IS NULL",
+                values_all,
+            )
+        )
+        return partitions
+    raise ValueError(f"Unsupported partition scheme: {config['scheme']}")
+
+
+def run_partitions(pool, partitions, func):
+    """Run `func(conn, sql, params)` for each partition on its own pooled session
+
+    Returns:
+        list: The result of each partition, in partition order
+    """
+
+    def run(partition):
+        conn = pool.acquire()
+        try:
+            return func(conn, *partition)
+        finally:
+            pool.release(conn)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        return list(executor.map(run, partitions))
+
+
+def fetch_partitioned(pool, partitions):
+    """ fetch all rows of a query, with each partition fetched concurrently """
+    results = run_partitions(pool, partitions, fetch_rows)
+    return [row for rows in results for row in rows]
+
+
+def count_rows(conn, query, params=None):
+    """ return the number of rows returned by a query """
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT COUNT(*) FROM ({query})", params or [])
+    return cursor.fetchone()[0]
+
+
+def verify_partitions(name):
+    """Check that the partitions of a record type's query return the same number of
+    rows as the query itself
+
+    Raises:
+        IOError: If the row counts do not match
+    """
+    query = QUERIES[name]
+    partitions = partition_queries(query, PARTITIONS[name])
+    # the unpartitioned count runs alongside the partition counts
+    pool = get_pool(HOST, PORT, SERVICE, USER, PASSWORD, len(partitions) + 1)
+    try:
+        counts = run_partitions(pool, [(query, None)] + partitions, count_rows)
+    finally:
+        pool.close()
+    total, partition_counts = counts[0], counts[1:]
+    logging.info(
+        f"{name}: {total} rows, {sum(partition_counts)} in partitions {partition_counts}"
+    )
+    if sum(partition_counts) != total:
+        raise IOError(
+            f"The partitions of {name} returned {sum(partition_counts)} rows rather than {total}"
+        )
+
+
 def get_conn(host, port, service, user, password):
+    # cx_Oracle is imported here, rather than with the module, so that the upload
+    # functions can be used (e.g. by benchmark.py) without the Oracle client
+    import cx_Oracle
+
     # Need to run this once if you want to work locally
     # Change lib_dir to your cx_Oracle library location
     # https://stackoverflow.com/questions/56119490/cx-oracle-error-dpi-1047-cannot-locate-a-64-bit-oracle-client-library
@@ -43,6 +576,23 @@ def get_conn(host, port, service, user, password):
     return cx_Oracle.connect(user=user, password=password, dsn=dsn_tns)
 
 
+def get_pool(host, port, service, user, password, max_sessions):
+    """ return a session pool which holds up to `max_sessions` DB connections """
+    import cx_Oracle
+
+    dsn_tns = cx_Oracle.makedsn(host, port, service_name=service)
+    return cx_Oracle.SessionPool(
+        user=user,
+        password=password,
+        dsn=dsn_tns,
+        min=1,
+        max=max_sessions,
+        increment=1,
+        threaded=True,
+        getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+    )
+
+
 def cli_args():
     parser = argparse.ArgumentParser(
         description="Extract finance data and load to AWS S3"
@@ -50,52 +600,275 @@ def cli_args():
     parser.add_argument(
         "name",
         type=str,
-        choices=list(QUERIES.keys()),
-        help="The name of the financial data to be processed.",
+        nargs="+",
+        choices=list(QUERIES.keys()) + ["all"],
+        help="The name(s) of the financial data to be processed, or 'all'.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream rows from the DB to S3 in batches, rather than holding them all in memory.",
+    )
+    parser.add_argument(
+        "--arraysize",
+        type=int,
+        default=ARRAYSIZE,
+        help="The number of rows to fetch from the DB per round trip when streaming.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch records which have changed since the last run. Falls back to a full extract if there is no saved state.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Upload the records even if they have not changed since the last upload.",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="Split the queries of record types listed in queries.PARTITIONS into partitions which run concurrently.",
+    )
+    parser.add_argument(
+        "--verify-partitions",
+        action="store_true",
+        help="Check that the partitioned queries return as many rows as the unpartitioned queries, without uploading anything.",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=PARALLEL,
+        help=f"The number of queries to run at once when processing more than one record type. Defaults to {PARALLEL}.",
+    )
+    args = parser.parse_args()
+    if args.incremental and args.stream:
+        parser.error("--incremental cannot be combined with --stream")
+    if args.incremental:
+        unsupported = [
+            name for name in args.name if name != "all" and name not in INCREMENTAL
+        ]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} does not support incremental extraction")
+    if args.partitioned and (args.stream or args.incremental):
+        parser.error("--partitioned cannot be combined with --stream or --incremental")
+    if args.partitioned or args.verify_partitions:
+        unsupported = [
+            name for name in args.name if name != "all" and name not in PARTITIONS
+        ]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} does not support partitioned extraction")
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    # with `all`, record types which support incremental or partitioned extraction
+    # use it
+    args.names = list(QUERIES) if "all" in args.name else list(dict.fromkeys(args.name))
+    return args
 
 
-def main():
-    args = cli_args()
-    name = args.name
-    conn = get_conn(HOST, PORT, SERVICE, USER, PASSWORD)
+def get_s3_client():
+    session = boto3.session.Session(
+        aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    )
+    return session.client(
+        "s3",
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    )
+
+
+def extract_and_upload(name, conn, client, args, job_metrics):
+    """Extract a record type from the DB and upload it to S3
+
+    Args:
+        name (str): The record type name, a key of QUERIES
+        conn (cx_Oracle.Connection): The DB connection. It is not closed here.
+        client (botocore.client.S3): An S3 client
+        args (argparse.Namespace): The CLI arguments
+        job_metrics (metrics.Metrics): Records the time spent in each stage
+
+    Returns:
+        int: The number of rows uploaded
+    """
+    file_name = f"{name}.json"
     query = QUERIES[name]
-    cursor = conn.cursor()
+    # the snapshot is only replaced if its checksum has changed
+    previous_checksum = (
+        None if args.force else s3_cache.snapshot_checksum(client, BUCKET, name)
+    )
+
+    if args.stream:
+        cursor = conn.cursor()
+        # fetch and upload one batch at a time so memory use does not grow with the
+        # size of the dataset
+        cursor.arraysize = args.arraysize
+        cursor.prefetchrows = args.arraysize + 1
+        with job_metrics.stage("query"):
+            cursor.execute(query)
+        count, uploaded = upload_snapshot(
+            client,
+            BUCKET,
+            name,
+            fetch_batches(cursor, args.arraysize, job_metrics),
+            job_metrics=job_metrics,
+            previous_checksum=previous_checksum,
+        )
+        # an unchanged snapshot still matches the incremental state, if any
+        if uploaded:
+            invalidate_state(client, name)
+        logging.info(f"{count} {name} records processed.")
+        return count
+
+    if args.incremental and name in INCREMENTAL:
+        config = INCREMENTAL[name]
+        state_name = state_file_name(name)
+        with job_metrics.stage("download"):
+            rows_previous = s3_cache.load_json(client, file_name, bucket_name=BUCKET)
+            state_previous = s3_cache.load_json(client, state_name, bucket_name=BUCKET)
+        with job_metrics.stage("query") as stage:
+            if rows_previous is None or state_previous is None:
+                logging.info(
+                    f"No previous {name} extraction state found. Fetching all records."
+                )
+                rows, state = extract_full(conn, query, config)
+                stage["rows"] = len(rows)
+            else:
+                rows, state, count_changed = extract_incremental(
+                    conn, query, config, rows_previous, state_previous
+                )
+                stage["rows"] = count_changed
+                if not count_changed:
+                    logging.info(f"No {name} records have changed. Nothing to upload.")
+                    return 0
+
+        if not rows:
+            raise IOError(
+                "No data was retrieved from the financial database. This should never happen!"
+            )
+        # upload the records before the state, so that a failed upload leads to the
+        # changes being fetched again on the next run
+        upload_snapshot(
+            client,
+            BUCKET,
+            name,
+            [rows],
+            job_metrics=job_metrics,
+            previous_checksum=previous_checksum,
+        )
+        client.upload_fileobj(fileobj(state), BUCKET, state_name)
+        logging.info(f"{len(rows)} {name} records processed.")
+        return len(rows)
+
     # some queries may take a while to complete:
     # - task orders: ~4 min
     # - units: ~1 min
     # - objects: 30 seconds
     # - master_agreements: 15 seconds
-    cursor.execute(query)
-
-    # define row handler which returns each row as a dict
-    # h/t https://stackoverflow.com/questions/35045879/cx-oracle-how-can-i-receive-each-row-as-a-dictionary
-    cursor.rowfactory = lambda *args: dict(
-        zip([d[0] for d in cursor.description], args)
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    with job_metrics.stage("query") as stage:
+        if args.partitioned and name in PARTITIONS:
+            partitions = partition_queries(query, PARTITIONS[name])
+            pool = get_pool(HOST, PORT, SERVICE, USER, PASSWORD, len(partitions))
+            try:
+                rows = fetch_partitioned(pool, partitions)
+            finally:
+                pool.close()
+        else:
+            rows = fetch_rows(conn, query)
+        stage["rows"] = len(rows)
 
     if not rows:
         raise IOError(
             "No data was retrieved from the financial database. This should never happen!"
         )
 
-    file = fileobj(rows)
-    file_name = f"{name}.json"
-    session = boto3.session.Session(
-        aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-    )
-    client = session.client(
-        "s3",
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    )
-    client.upload_fileobj(
-        file, BUCKET, file_name,
+    _, uploaded = upload_snapshot(
+        client,
+        BUCKET,
+        name,
+        [rows],
+        job_metrics=job_metrics,
+        previous_checksum=previous_checksum,
     )
-    logging.info(f"{len(rows)} records processed.")
+    if uploaded:
+        invalidate_state(client, name)
+    logging.info(f"{len(rows)} {name} records processed.")
+    return len(rows)
+
+
+def run_query(name, pool, client, args):
+    """Extract and upload a record type on a pooled session. Errors are logged
+    rather than raised, so that they do not stop the other record types.
+
+    Returns:
+        dict: The record type's status, number of rows uploaded and run time in
+            seconds
+    """
+    job_metrics = metrics.Metrics("upload_to_s3", {"record_type": name})
+    start = time.monotonic()
+    try:
+        conn = pool.acquire()
+        try:
+            rows = extract_and_upload(name, conn, client, args, job_metrics)
+        finally:
+            pool.release(conn)
+    except Exception:
+        logging.exception(f"Failed to process {name}")
+        return {"status": "failed", "rows": 0, "seconds": time.monotonic() - start}
+    finally:
+        job_metrics.write_textfile()
+    return {"status": "ok", "rows": rows, "seconds": time.monotonic() - start}
+
+
+def log_summary(results):
+    """ log a table of the status, row count and run time of each record type """
+    logging.info(f"{'record type':<20}{'status':<10}{'rows':>10}{'seconds':>10}")
+    for name, result in results.items():
+        logging.info(
+            f"{name:<20}{result['status']:<10}{result['rows']:>10}{result['seconds']:>10.1f}"
+        )
+
+
+def main():
+    args = cli_args()
+
+    if args.verify_partitions:
+        for name in args.names:
+            if name in PARTITIONS:
+                verify_partitions(name)
+        return
+
+    client = get_s3_client()
+
+    if len(args.names) == 1:
+        name = args.names[0]
+        job_metrics = metrics.Metrics("upload_to_s3", {"record_type": name})
+        conn = get_conn(HOST, PORT, SERVICE, USER, PASSWORD)
+        try:
+            extract_and_upload(name, conn, client, args, job_metrics)
+        finally:
+            conn.close()
+            job_metrics.write_textfile()
+        return
+
+    # connect once and run the queries on concurrent sessions. each record type is
+    # uploaded as soon as its query completes.
+    parallel = min(args.parallel, len(args.names))
+    pool = get_pool(HOST, PORT, SERVICE, USER, PASSWORD, parallel)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {
+                name: executor.submit(run_query, name, pool, client, args)
+                for name in args.names
+            }
+        results = {name: future.result() for name, future in futures.items()}
+    finally:
+        pool.close()
+
+    log_summary(results)
+
+    failed = [name for name in args.names if results[name]["status"] == "failed"]
+    if failed:
+        raise IOError(f"Failed to process: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
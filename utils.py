@@ -1,12 +1,17 @@
 import logging
 import sys
 
-def get_logger(name, level):
+def get_logger(name, level, fmt="%(asctime)s %(levelname)s: %(message)s"):
     """Return a module logger that streams to stdout"""
     logger = logging.getLogger(name)
-    formatter = logging.Formatter(fmt="%(asctime)s %(levelname)s: %(message)s")
+    logger.setLevel(level)
+    if logger.handlers:
+        # the logger has already been set up
+        return logger
+    formatter = logging.Formatter(fmt=fmt)
     handler = logging.StreamHandler(stream=sys.stdout)
     handler.setFormatter(formatter)
     logger.addHandler(handler)
-    logger.setLevel(level)
+    # don't also log our messages through the root logger's handlers
+    logger.propagate = False
     return logger
\ No newline at end of file